@@ -1,4 +1,4 @@
-import asyncio, logging, time
+import asyncio, collections, logging, time
 
 import plugins
 
@@ -8,6 +8,8 @@ logger = logging.getLogger(__name__)
 
 class CommandDispatcher(object):
     """Register commands and run them"""
+    available_cache_limit = 1000 # (chat_id, conv_id) results kept, least recently used are dropped
+
     def __init__(self):
         self.bot = None
         self.commands = {}
@@ -18,6 +20,22 @@ class CommandDispatcher(object):
 
         self.command_tagsets = {}
 
+        """get_available_commands() caches, reset whenever commands or config change
+        per-user results are also checked against the user's current active tags"""
+        self._version = 0 # incremented by invalidate()
+        self._cache_versions = None
+        self._conv_rules = {} # conv_id: config-derived rules
+        self._available = collections.OrderedDict() # (chat_id, conv_id): (active tags used, result)
+
+        """tags are interned to bits, tagsets and active user tags become integer masks"""
+        self._tag_bits = {} # tag: 1 << id
+        self._tag_masks = {} # (frozenset of active tags, number of interned tags): mask
+
+    def invalidate(self):
+        """drop cached command availability, call after modifying commands, admin_commands
+        or command_tagsets directly"""
+        self._version += 1
+
     def set_bot(self, bot):
         self.bot = bot
 
@@ -51,6 +69,7 @@ class CommandDispatcher(object):
             tagsets = set([tagsets])
 
         self.command_tagsets[command] = self.command_tagsets[command] | tagsets
+        self.invalidate()
 
 
     @property
@@ -63,17 +82,24 @@ class CommandDispatcher(object):
         config_tags_escalate = self.bot.get_config_option('commands.tags.escalate') or False
         return config_tags_escalate
 
-    def get_available_commands(self, bot, chat_id, conv_id):
-        start_time = time.time()
+    def _get_conv_rules(self, bot, conv_id):
+        """command sets and normalised tagsets for a conversation, everything that does not
+        depend on the user"""
+        versions = (self._version, bot.config.version)
+        if versions != self._cache_versions:
+            self._cache_versions = versions
+            self._conv_rules = {}
+            self._available = collections.OrderedDict()
+            self._tag_bits = {}
+            self._tag_masks = {}
+
+        rules = self._conv_rules.get(conv_id)
+        if rules is not None:
+            return rules
 
         config_tags_deny_prefix = self.deny_prefix
         config_tags_escalate = self.escalate_tagged
 
-        config_admins = bot.get_config_suboption(conv_id, 'admins')
-        is_admin = False
-        if chat_id in config_admins:
-            is_admin = True
-
         commands_admin = bot.get_config_suboption(conv_id, 'commands_admin') or []
         commands_user = bot.get_config_suboption(conv_id, 'commands_user') or []
         commands_tagged = bot.get_config_suboption(conv_id, 'commands_tagged') or {}
@@ -111,53 +137,107 @@ class CommandDispatcher(object):
             admin_commands = set(commands_admin) | set(self.admin_commands)
             user_commands = all_commands - admin_commands
 
-        # make admin commands unavailable to non-admin user
-        if not is_admin:
-            admin_commands = set()
+        # (allow, deny) tagset masks per tagged command
+        # optimisation: don't check commands that aren't loaded into framework
+        tagged = {}
+        for command, tags in commands_tagged.items():
+            if command not in all_commands:
+                continue
+            tagged[command] = []
+            for _match in tags:
+                _set_allow = [_match] if isinstance(_match, str) else _match
+                _set_deny = [ config_tags_deny_prefix + x for x in _set_allow ]
+                tagged[command].append((self._tags_mask(_set_allow, True), self._tags_mask(_set_deny, True)))
+
+        # raise tagged command access level if escalation required
+        if config_tags_escalate:
+            user_commands = user_commands - set(tagged)
+
+        rules = { "admins": bot.get_config_suboption(conv_id, 'admins'),
+                  "admin": frozenset(admin_commands),
+                  "user": frozenset(user_commands),
+                  "tagged": tagged }
+
+        self._conv_rules[conv_id] = rules
+        return rules
+
+    def _tags_mask(self, tags, intern=False):
+        """bitmask of tags, tags that no tagged command uses are left out unless interned"""
+        mask = 0
+        for tag in tags:
+            bit = self._tag_bits.get(tag)
+            if bit is None:
+                if not intern:
+                    continue
+                bit = self._tag_bits[tag] = 1 << len(self._tag_bits)
+            mask |= bit
+        return mask
+
+    def get_available_commands(self, bot, chat_id, conv_id):
+        """returns { "admin": frozenset, "user": frozenset } of commands chat_id may run in conv_id"""
+        start_time = time.time()
 
-        if commands_tagged:
-            _set_user_tags = set(bot.tags.useractive(chat_id, conv_id))
+        rules = self._get_conv_rules(bot, conv_id)
+        tagged = rules["tagged"]
 
-            for command, tags in commands_tagged.items():
-                if command not in all_commands:
-                    # optimisation: don't check commands that aren't loaded into framework
-                    continue
+        _set_user_tags = bot.tags.useractive(chat_id, conv_id) if tagged else None
+
+        cached = self._available.get((chat_id, conv_id))
+        if cached is not None and cached[0] == _set_user_tags:
+            self._available.move_to_end((chat_id, conv_id))
+            return cached[1]
+
+        is_admin = False
+        if chat_id in rules["admins"]:
+            is_admin = True
+
+        user_commands = set(rules["user"])
+
+        if is_admin:
+            # admins always get access to tagged commands
+            admin_commands = rules["admin"] | ( set(tagged) - user_commands )
 
-                # raise tagged command access level if escalation required
-                if config_tags_escalate and command in user_commands:
-                    user_commands.remove(command)
-
-                # is tagged command generally available (in user_commands)?
-                # admins always get access, other users need appropriate tag(s)
-                # XXX: optimisation: check admin_commands to avoid unnecessary scanning
-                if command not in user_commands|admin_commands:
-                    for _match in tags:
-                        _set_allow = set([_match] if isinstance(_match, str) else _match)
-                        if is_admin or _set_allow <= _set_user_tags:
-                            admin_commands.update([command])
+        else:
+            # a mask only covers tags interned when it was computed, other conversations can intern more
+            _mask_key = (_set_user_tags, len(self._tag_bits))
+            user_mask = self._tag_masks.get(_mask_key)
+            if user_mask is None:
+                if len(self._tag_masks) >= self.available_cache_limit:
+                    self._tag_masks = {}
+                user_mask = self._tag_masks[_mask_key] = self._tags_mask(_set_user_tags or ())
+
+            # make admin commands unavailable to non-admin user, other users need appropriate tag(s)
+            # a tagset is satisfied if the user has all of its tags: allow & ~user == 0
+            admin_commands = set()
+            for command, tagsets in tagged.items():
+                if command not in user_commands:
+                    for allow_mask, deny_mask in tagsets:
+                        if not allow_mask & ~user_mask:
+                            admin_commands.add(command)
                             break
 
-            if not is_admin:
-                # tagged commands can be explicitly denied
-                _denied = set()
-                for command in user_commands|admin_commands:
-                    if command in commands_tagged:
-                        tags = commands_tagged[command]
-                        for _match in tags:
-                            _set_allow = set([_match] if isinstance(_match, str) else _match)
-                            _set_deny = { config_tags_deny_prefix + x for x in _set_allow }
-                            if _set_deny <= _set_user_tags:
-                                _denied.update([command])
-                                break
-                admin_commands = admin_commands - _denied
-                user_commands = user_commands - _denied
+            # tagged commands can be explicitly denied
+            _denied = set()
+            for command in (user_commands | admin_commands) & tagged.keys():
+                for allow_mask, deny_mask in tagged[command]:
+                    if not deny_mask & ~user_mask:
+                        _denied.add(command)
+                        break
+            admin_commands = admin_commands - _denied
+            user_commands = user_commands - _denied
 
         user_commands = user_commands - admin_commands # ensure no overlap
 
+        result = { "admin": frozenset(admin_commands), "user": frozenset(user_commands) }
+        self._available[(chat_id, conv_id)] = (_set_user_tags, result)
+        self._available.move_to_end((chat_id, conv_id))
+        while len(self._available) > self.available_cache_limit:
+            self._available.popitem(last=False)
+
         interval = time.time() - start_time
         logger.debug("get_available_commands() - {}".format(interval))
 
-        return { "admin": list(admin_commands), "user": list(user_commands) }
+        return result
 
     @asyncio.coroutine
     def run(self, bot, event, *args, **kwds):
@@ -197,6 +277,7 @@ class CommandDispatcher(object):
                 self.commands[func_name] = func
                 if admin:
                     self.admin_commands.append(func_name)
+                self.invalidate()
 
             else:
                 # just register and return the same function
@@ -0,0 +1,113 @@
+import asyncio, json, logging
+
+import plugins
+
+import memory_retention
+
+
+logger = logging.getLogger(__name__)
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["memoryretention", "memorystats"])
+
+    rules, interval = memory_retention.get_rules(bot)
+    if interval:
+        if interval < memory_retention.MINIMUM_INTERVAL:
+            logger.warning("memory-retention interval {}s is below the minimum of {}s, scheduled retention disabled".format(
+                interval, memory_retention.MINIMUM_INTERVAL))
+        else:
+            plugins.start_asyncio_task(_scheduled_retention, interval)
+
+
+@asyncio.coroutine
+def _scheduled_retention(bot, interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        try:
+            report = memory_retention.run(bot, apply=True)
+            for line in _format_report(report):
+                logger.info(line)
+        except Exception as e:
+            logger.exception("scheduled retention failed")
+
+
+def _format_report(report):
+    lines = []
+    for key, result in sorted(report.items()):
+        lines.append("{}: {} removed, {:.1f} KB reclaimed, save {:.0f}ms -> {:.0f}ms".format(
+            key,
+            result["removed"],
+            (result["bytes_before"] - result["bytes_after"]) / 1024,
+            result["save_before"] * 1000,
+            result["save_after"] * 1000))
+    return lines
+
+
+def memoryretention(bot, event, *args):
+    """evaluate memory retention rules, nothing is removed unless "apply" is supplied
+    /bot memoryretention [apply]"""
+    apply = len(args) > 0 and args[0].lower() == "apply"
+
+    report = memory_retention.run(bot, apply=apply)
+
+    lines = [ _("<b>memory retention ({})</b>").format(_("applied") if apply else _("dry run")) ]
+    lines.extend(_format_report(report) or [ _("<em>nothing to remove</em>") ])
+
+    yield from bot.coro_send_message(event.conv_id, "<br />".join(lines))
+
+
+def _format_metrics(metrics):
+    totals = metrics["totals"]
+    load = metrics["load"]
+
+    lines = [ "<b>{}</b>".format(metrics["filename"]) ]
+    if load:
+        lines.append(_("load: {} {:.1f} KB in {:.0f}ms, {} deferred, {} journal records").format(
+            load["mode"], load["bytes"] / 1024, load["duration"] * 1000, load["deferred"], load["journal_replayed"]))
+
+    for kind in ("snapshot", "journal", "sqlite"):
+        count = totals.get(kind, 0)
+        if not count:
+            continue
+        lines.append(_("{}: {} writes, {:.1f} KB, avg {:.1f}ms (serialise {:.1f}ms, backup {:.1f}ms, fsync {:.1f}ms)").format(
+            kind, count,
+            totals.get(kind + "_bytes", 0) / 1024,
+            totals.get(kind + "_total", 0) / count * 1000,
+            totals.get(kind + "_serialise", 0) / count * 1000,
+            totals.get(kind + "_backup", 0) / count * 1000,
+            totals.get(kind + "_fsync", 0) / count * 1000))
+
+    lines.append(_("save requests: {}, coalesced: {}").format(
+        totals.get("save_requests", 0), totals.get("coalesced", 0)))
+
+    cache = metrics["suboption_cache"]
+    lines.append(_("suboption cache: {} hits, {} misses, {} entries").format(
+        cache["hits"], cache["misses"], cache["size"]))
+
+    tainted_by = sorted(metrics["tainted_by"].items(), key=lambda item: item[1], reverse=True)
+    if tainted_by:
+        lines.append(_("tainted by:"))
+        for caller, count in tainted_by[:10]:
+            lines.append("... {}: {}".format(caller, count))
+
+    return lines
+
+
+def memorystats(bot, event, *args):
+    """save/load statistics for memory and config, "json" for machine-readable output
+    /bot memorystats [json]"""
+    metrics = { "memory": bot.memory.metrics(),
+                "config": bot.config.metrics() }
+
+    if len(args) > 0 and args[0].lower() == "json":
+        message = json.dumps(metrics, sort_keys=True)
+    else:
+        lines = []
+        for name in ("memory", "config"):
+            lines.extend(_format_metrics(metrics[name]))
+        message = "<br />".join(lines)
+
+    yield from bot.coro_send_message(event.conv_id, message)
+
+    return { "api.response": json.dumps(metrics, sort_keys=True) }
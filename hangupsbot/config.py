@@ -1,128 +1,958 @@
-import collections, datetime, functools, json, glob, logging, os, shutil, sys, time
+import asyncio, collections, copy, datetime, json, glob, logging, mmap, os, re, shutil, sys, threading, time, urllib.parse, zlib
 
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger(__name__)
 
 
+_MISSING = object() # sentinel for path lookups, distinguishes absent keys from stored None
+
+
+def json_default(value):
+    """json.dumps() default hook: other mapping types stored in the tree (permamem records)
+    serialise as plain objects"""
+    if isinstance(value, collections.MutableMapping):
+        return dict(value.items())
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _field(record, path):
+    """value at path inside a record, None if any part of it is absent"""
+    node = record
+    for key in path:
+        if not isinstance(node, collections.MutableMapping):
+            return None
+        node = node.get(key)
+    return node
+
+
+def _fragment(text):
+    """nest a serialised top-level value exactly as json.dump(indent=2) would"""
+    return text.replace("\n", "\n  ")
+
+
+_FAILSAFE_SUFFIX = re.compile(r"\.\d{14}(?:\.([0-9a-f]{8}))?\.bak$") # .<timestamp>[.<crc32>].bak
+
+
+_LAZY_KEY = re.compile(rb'\n  ("(?:[^"\\\n]|\\.)*"): ')
+_LAZY_MIN_SIZE = 4096 # smaller top-level values are parsed straight away
+
+
+class _Span:
+    """raw json text of a top-level value inside a memory-mapped file
+    str() decodes it, so a span can stand in for a serialised fragment"""
+    __slots__ = ("buffer", "start", "end")
+
+    def __init__(self, buffer, start, end):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return self.buffer[self.start:self.end].decode("utf-8")
+
+
+class _LazyTree(collections.MutableMapping):
+    """top-level mapping whose values may still be unparsed _Span placeholders,
+    each is parsed and replaced by its value on first access
+    not a dict subclass: dict(tree), {**tree} and the copy module would otherwise read the
+    placeholders straight from dict storage, here every value goes through __getitem__"""
+    def __init__(self, fallback):
+        self._data = {}
+        self._fallback = fallback
+        self.pending = set()
+
+    def _resolve(self, key, span):
+        try:
+            value = json.loads(str(span))
+        except ValueError:
+            # index does not match the file after all, take every pending value from a full parse
+            data = self._fallback(span)
+            for pending_key in self.pending:
+                if pending_key in data:
+                    self._data[pending_key] = data[pending_key]
+                else:
+                    del self._data[pending_key]
+            self.pending = set()
+            return self._data[key]
+
+        self._data[key] = value
+        self.pending.discard(key)
+        return value
+
+    def materialise(self):
+        for key in list(self.pending):
+            if key in self.pending:
+                self[key]
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if type(value) is _Span:
+            value = self._resolve(key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self.pending.discard(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self.pending.discard(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.pending = set()
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        self.materialise()
+        return self._data.items()
+
+    def values(self):
+        self.materialise()
+        return self._data.values()
+
+    def copy(self):
+        self.materialise()
+        return dict(self._data)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        self.materialise()
+        return copy.deepcopy(self._data, memo)
+
+
 class Config(collections.MutableMapping):
     """Configuration JSON storage class"""
-    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0):
+    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0, journal=False, journal_compact=1000,
+                 shards=None, failsafe_interval=0, failsafe_size=0, lazy=False, compact=False):
         self.filename = filename
         self.default = None
         self.config = {}
         self.changed = False
-        self.failsafe_backups = failsafe_backups
         self.save_delay = save_delay
-        self.load()
 
-        self._timer_save = False
+        """failsafe backups are hardlinks of the previously written file, named with its crc32
+        a new backup is only taken once failsafe_interval seconds have passed or failsafe_size
+        bytes were written since the last one (every save if both are 0)"""
+        self.failsafe_backups = failsafe_backups
+        self.failsafe_interval = failsafe_interval
+        self.failsafe_size = failsafe_size
+        self._failsafe_checksums = {} # filename: crc32 of the file as last read/written
+        self._failsafe_schedule = {} # filename: [time of last backup, bytes written since]
+
+        """dirty tracking per top-level key, saves only reserialise the keys that changed
+        values changed in-place (without set_by_path() or item assignment) need force_taint()
+        shards = [ "key", ... ] or True: persist those top-level keys to their own files in
+        <filename>.shards/, each with separate failsafe backups"""
+        self.shards = shards
+        self._shards_path = filename + ".shards"
+        self._dirty = set()
+        self._dirty_all = False
+        self._fragments = {} # serialised main file fragments per key, or their mapped text
+        self._written_main_keys = set()
+        self._shard_keys_on_disk = set()
+
+        """journal mode: mutations are appended to <filename>.journal as path-level records
+        and periodically folded into the full snapshot after journal_compact records
+        changed paths are collected and their current values serialised when the journal is flushed,
+        so in-place changes made after set_by_path() are included"""
+        self.journal = journal
+        self.journal_compact = journal_compact
+        self._journal_filename = filename + ".journal"
+        self._journal_pending = collections.OrderedDict() # path: None, in order of last change
+        self._journal_records = 0
+        self._journal_snapshot_required = False
+
+        """lazy loading: the file is memory-mapped and only its top-level keys are indexed on load,
+        large values are parsed when first accessed. unchanged values are written back from the
+        mapped text. the file must not be edited in-place while it is mapped"""
+        self.lazy = lazy
+
+        """incremented on every change, lets callers cache values derived from the tree"""
+        self.version = 0
+
+        """resolved get_suboption() lookups, dropped whenever a top-level key they depend on changes"""
+        self._suboption_cache = {}
+        self._suboption_dependents = {} # top-level key: set of cache keys
+        self.suboption_cache_hits = 0
+        self.suboption_cache_misses = 0
+
+        """save/load instrumentation, see metrics()
+        taints are attributed to the first calling function outside the storage modules"""
+        self._metrics_lock = threading.Lock()
+        self._metrics_saves = collections.deque(maxlen=50)
+        self._metrics_totals = collections.Counter()
+        self._metrics_load = {}
+        self._metrics_tainted_by = collections.Counter()
+
+        """saves serialise the changed keys on the event loop, the writer thread only receives text
+        and writes it in submission order. compact=True keeps each top-level value on a single line,
+        produced by the C encoder, the indented default uses the much slower pure-Python one"""
+        self.compact = compact
+        self._loop = asyncio.get_event_loop()
+        self._writer = None
+        self._writer_futures = set() # submitted, result not handled yet
+        self._writer_exception = None
+        self._timer_save = None
 
-    def _make_failsafe_backup(self):
-        try:
-            json.load(open(self.filename))
-        except IOError:
+        self.load()
+
+    def _failsafe_existing(self, filename):
+        """backups oldest first, a hardlink keeps the mtime of the file it preserved
+        only names created by _make_failsafe_backup() (or legacy ones without a checksum) are
+        included, other *.bak files next to filename are never rotated or restored"""
+        def _age(backup_file):
+            try:
+                return (os.path.getmtime(backup_file), backup_file)
+            except OSError:
+                return (0, backup_file)
+        return sorted([ backup_file for backup_file in glob.glob(glob.escape(filename) + ".*.bak")
+                        if _FAILSAFE_SUFFIX.match(backup_file, len(filename)) ], key=_age)
+
+    def _make_failsafe_backup(self, filename, size=0):
+        """runs on the writer thread before filename is replaced, never re-reads the file
+        the checksum recorded when the file was last read or written goes into the backup name"""
+        now = time.time()
+
+        schedule = self._failsafe_schedule.setdefault(filename, [0, 0])
+        schedule[1] = schedule[1] + size
+        if ( (self.failsafe_interval or self.failsafe_size)
+                and not (self.failsafe_interval and now - schedule[0] >= self.failsafe_interval)
+                and not (self.failsafe_size and schedule[1] >= self.failsafe_size) ):
             return False
-        except ValueError:
-            logger.warning("{} is corrupted, aborting backup".format(self.filename))
+
+        checksum = self._failsafe_checksums.get(filename)
+        if checksum is None:
+            # file was not produced or validated by us, nothing trustworthy to keep
             return False
 
-        existing = sorted(glob.glob(self.filename + ".*.bak"))
+        existing = self._failsafe_existing(filename)
         while len(existing) > (self.failsafe_backups - 1):
             os.remove(existing.pop(0))
 
-        backup_file = self.filename + "." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".bak"
-        shutil.copy2(self.filename, backup_file)
+        backup_file = "{}.{}.{:08x}.bak".format(filename, datetime.datetime.now().strftime("%Y%m%d%H%M%S"), checksum)
+        try:
+            if os.path.lexists(backup_file):
+                # more than one backup within the same second, keep the latest
+                os.remove(backup_file)
+            os.link(filename, backup_file)
+        except OSError:
+            # no hardlink support on this filesystem
+            shutil.copy2(filename, backup_file)
+
+        schedule[0] = now
+        schedule[1] = 0
 
         return True
 
-    def _recover_from_failsafe(self):
-        existing = sorted(glob.glob(self.filename + ".*.bak"))
+    def _recover_from_failsafe(self, filename, restore=True):
+        """newest backup first, backups with a checksum in their name are verified before
+        parsing, legacy backups (without one) are only parsed
+        restore=False leaves filename untouched, used while it is still memory-mapped"""
+        existing = self._failsafe_existing(filename)
         while len(existing) > 0:
             try:
                 recovery_filename = existing.pop()
-                json.load(open(recovery_filename))
-                shutil.copy2(recovery_filename, self.filename)
-                self.load(recovery=True)
+                raw = open(recovery_filename, 'rb').read()
+
+                expected = _FAILSAFE_SUFFIX.match(recovery_filename, len(filename))
+                if expected.group(1) and int(expected.group(1), 16) != zlib.crc32(raw):
+                    raise ValueError("checksum mismatch")
+
+                data = json.loads(raw.decode("utf-8"))
+                if restore:
+                    shutil.copy2(recovery_filename, filename)
+                    self._failsafe_checksums[filename] = zlib.crc32(raw)
                 logger.info("recovery successful: {}".format(recovery_filename))
-                return True
+                return data
             except IOError:
                 pass
             except ValueError:
-                logger.error("corrupted recovery: {}".format(self.filename))
-        return False
+                logger.error("corrupted recovery: {}".format(recovery_filename))
+        return None
 
-    def load(self, recovery=False):
-        """Load config from file"""
+    def _read_json(self, filename):
+        try:
+            raw = open(filename, 'rb').read()
+            data = json.loads(raw.decode("utf-8"))
+            self._failsafe_checksums[filename] = zlib.crc32(raw)
+            logger.info("{} read".format(filename))
+
+        except ValueError:
+            if self.failsafe_backups > 0:
+                data = self._recover_from_failsafe(filename)
+                if data is not None:
+                    return data
+
+            raise
+
+        return data
+
+    def _read_lazy(self, filename):
+        """index the top-level keys of a file written by _write_snapshot without parsing their
+        values, returns None if the file does not have that layout (full parse instead)"""
+        with open(filename, 'rb') as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return None
+
+        end = len(buffer)
+        while end > 0 and buffer[end-1:end].isspace():
+            end = end - 1
+
+        tree = _LazyTree(self._lazy_fallback)
+        tree.spans = {}
+
+        if buffer[:end] == b"{}":
+            pass
+        elif buffer[:5] == b'{\n  "' and buffer[end-2:end] == b"\n}":
+            match = _LAZY_KEY.match(buffer, 1)
+            while match is not None:
+                key = json.loads(match.group(1).decode("utf-8"))
+                start = match.end()
+
+                next_key = buffer.find(b'\n  "', start, end)
+                if next_key == -1:
+                    value_end = end - 2
+                elif buffer[next_key-1:next_key] == b",":
+                    value_end = next_key - 1
+                else:
+                    return None
+
+                span = _Span(buffer, start, value_end)
+                tree.spans[key] = span
+                if len(span) < _LAZY_MIN_SIZE:
+                    try:
+                        tree._data[key] = json.loads(str(span))
+                    except ValueError:
+                        return None
+                else:
+                    tree._data[key] = span
+                    tree.pending.add(key)
+
+                match = None if next_key == -1 else _LAZY_KEY.match(buffer, next_key)
+                if next_key != -1 and match is None:
+                    return None
+        else:
+            return None
+
+        self._failsafe_checksums[filename] = zlib.crc32(buffer)
+        logger.info("{} indexed, {} keys, {} deferred".format(filename, len(tree), len(tree.pending)))
+
+        return tree
+
+    def _lazy_fallback(self, span):
+        """a lazily indexed value did not parse: the file is damaged or only looked like our layout"""
+        logger.warning("{} lazy index invalid, parsing the whole file".format(self.filename))
         try:
-            self.config = json.load(open(self.filename))
-            logger.info("{} read".format(self.filename))
+            data = json.loads(span.buffer[:].decode("utf-8"))
+        except ValueError:
+            logger.error("{} corrupted".format(self.filename))
+            data = self._recover_from_failsafe(self.filename, restore=False) if self.failsafe_backups else None
+            if data is None:
+                raise
+
+        # spans may also have been copied into the fragment cache, rewrite everything
+        self.force_taint()
+
+        return data
 
+    def _is_shard(self, key):
+        return self.shards is True or bool(self.shards and key in self.shards)
+
+    def _shard_filename(self, key):
+        return os.path.join(self._shards_path, urllib.parse.quote(key, safe="") + ".json")
+
+    def _load_shards(self):
+        """merge <filename>.shards/*.json into the loaded tree, a shard file always takes
+        precedence over a stale copy of the same key in the main file"""
+        if not os.path.isdir(self._shards_path):
+            return
+
+        for node_name in os.listdir(self._shards_path):
+            if not node_name.endswith(".json"):
+                continue
+
+            key = urllib.parse.unquote(node_name[:-5])
+            self.config[key] = self._read_json(os.path.join(self._shards_path, node_name))
+            self._shard_keys_on_disk.add(key)
+
+            if not self._is_shard(key):
+                # sharding was disabled for this key, move it back into the main file
+                self._dirty.add(key)
+
+    def load(self):
+        """Load config from file"""
+        self._writer_wait()
+
+        start_time = time.time()
+
+        try:
+            self.config = self._read_lazy(self.filename) if self.lazy else None
+            if self.config is None:
+                self.config = self._read_json(self.filename)
         except IOError:
             self.config = {}
 
-        except ValueError:
-            if not recovery and self.failsafe_backups > 0 and self._recover_from_failsafe():
-                return
+        self._dirty = set()
+        self._dirty_all = False
+        self._fragments = {}
 
-            raise
+        if isinstance(self.config, _LazyTree):
+            # the mapped text of every key is its current fragment
+            self._fragments = self.config.spans
+            del self.config.spans
+        self._written_main_keys = { key for key in self.config }
+        self._shard_keys_on_disk = set()
 
-        self.changed = False
+        for key in self.config:
+            if self._is_shard(key):
+                # first save after enabling sharding moves the key out of the main file
+                self._dirty.add(key)
+
+        self._journal_pending = collections.OrderedDict()
+        self._journal_records = 0
+        self._journal_snapshot_required = False
+
+        self._load_shards()
+        self._after_load()
+
+        if self.journal:
+            self._journal_replay()
+
+        self.changed = bool(self._dirty)
+        self._suboption_cache_clear()
+
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        self._metrics_load = { "time": start_time,
+                               "duration": time.time() - start_time,
+                               "bytes": size,
+                               "mode": "lazy" if isinstance(self.config, _LazyTree) else "full",
+                               "deferred": len(self.config.pending) if isinstance(self.config, _LazyTree) else 0,
+                               "shards": len(self._shard_keys_on_disk),
+                               "journal_replayed": self._journal_records }
+        with self._metrics_lock:
+            self._metrics_totals["loads"] += 1
+
+    def _after_load(self):
+        """hook for storage backends, runs before the journal is replayed"""
+        pass
+
+    def _persisted_keys(self):
+        """top-level keys written to the json file(s), backends may store others elsewhere"""
+        return set(self.config)
+
+    def _journal_replay(self):
+        """re-apply journal records written after the last snapshot"""
+        try:
+            with open(self._journal_filename) as f:
+                lines = f.readlines()
+        except IOError:
+            return
+
+        replayed = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a torn record can only be the last one written before a crash
+                logger.warning("{} truncated after {} records".format(self._journal_filename, replayed))
+                self._journal_snapshot_required = True
+                break
+            try:
+                self._journal_apply(*record)
+                self._dirty.add(record[1][0])
+            except (KeyError, IndexError, TypeError):
+                logger.warning("{} record skipped: {}".format(self._journal_filename, line.strip()))
+            replayed = replayed + 1
+
+        self._journal_records = replayed
+        logger.info("{} replayed {}".format(self._journal_filename, replayed))
+
+    def _journal_apply(self, op, keys_list, value=None):
+        target = self.config
+        for k in keys_list[:-1]:
+            target = target[int(k) if isinstance(target, list) else k]
+        key = int(keys_list[-1]) if isinstance(target, list) else keys_list[-1]
+
+        if op == "set":
+            target[key] = value
+        elif op == "pop":
+            if isinstance(target, list):
+                target.pop(key)
+            else:
+                target.pop(key, None)
+        else:
+            raise TypeError("unknown journal operation {}".format(op))
+
+    def _journal_append(self, keys_list):
+        """remember a changed path, its value is serialised by _journal_flush()"""
+        if not self.journal:
+            return
+
+        path = tuple(keys_list)
+        self._journal_pending[path] = None
+        self._journal_pending.move_to_end(path)
+
+    def _journal_serialise(self):
+        """one record per changed path with its current value, None if a path cannot be journalled
+        paths are replayed in order of their last change: a parent written after its child
+        carries the child's current value as well, a child of a removed parent is skipped"""
+        records = []
+        for path in self._journal_pending:
+            parent = self.config if len(path) == 1 else self._walk(path[:-1])
+            if parent is _MISSING or parent is None:
+                # removed or replaced since, the record of that change covers this path
+                continue
+            if not isinstance(parent, collections.MutableMapping):
+                # list positions shift, only a snapshot keeps them consistent
+                return None
+
+            value = parent.get(path[-1], _MISSING)
+            record = ["pop", list(path)] if value is _MISSING else ["set", list(path), value]
+            try:
+                records.append(json.dumps(record, separators=(',', ':'), default=json_default))
+            except (TypeError, ValueError):
+                # not representable as a record
+                return None
+
+        return records
+
+    def _journal_flush(self):
+        """queue pending records for the journal, returns False if a full snapshot is required"""
+        if self._journal_snapshot_required or self._journal_records >= self.journal_compact:
+            return False
+
+        pending = self._journal_serialise()
+        if pending is None:
+            return False
+        self._journal_pending = collections.OrderedDict()
+
+        if pending:
+            self._writer_submit(self._journal_write, pending)
+            self._journal_records = self._journal_records + len(pending)
+
+        return True
+
+    def _journal_write(self, pending):
+        start_time = time.time()
+
+        text = "\n".join(pending) + "\n"
+        with open(self._journal_filename, 'a') as f:
+            f.write(text)
+            f.flush()
+            fsync_start = time.time()
+            os.fsync(f.fileno())
+            fsync_time = time.time() - fsync_start
+
+        interval = time.time() - start_time
+
+        self._metrics_record("journal", bytes=len(text), records=len(pending), files=1,
+                             fsync=fsync_time, total=interval)
+
+        logger.debug("{} append {} {}".format(self._journal_filename, len(pending), interval))
+
+    def _journal_remove(self):
+        try:
+            os.remove(self._journal_filename)
+        except OSError:
+            pass
+
+    def _taint(self, key):
+        if key not in self._dirty:
+            # only the clean to dirty transition is attributed, that is what causes a write
+            self._metrics_taint()
+
+        self.changed = True
+        self._dirty.add(key)
+        self.version += 1
+
+        if key in self._suboption_dependents:
+            for cache_key in self._suboption_dependents.pop(key):
+                self._suboption_cache.pop(cache_key, None)
 
     def force_taint(self):
+        """mark everything as changed, required after modifying the tree in-place"""
+        if not self._dirty_all:
+            self._metrics_taint()
+
         self.changed = True
+        self._dirty_all = True
+        self._journal_snapshot_required = True
+        self._suboption_cache_clear()
 
     def loads(self, json_str):
         """Load config from JSON string"""
         self.config = json.loads(json_str)
-        self.changed = True
+        self.force_taint()
+
+    _metrics_storage_modules = { "config", "memory_sqlite" }
+    _metrics_core_modules = { "hangupsbot", "__main__" } # bot helpers, attributed to their caller if any
+
+    def _metrics_taint(self):
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_globals.get("__name__") in self._metrics_storage_modules:
+            frame = frame.f_back
+
+        caller = frame
+        while caller is not None and caller.f_globals.get("__name__") in self._metrics_core_modules:
+            caller = caller.f_back
+        if caller is not None and not caller.f_globals.get("__name__", "").startswith(("asyncio", "concurrent", "threading")):
+            # otherwise the bot itself was called by the event loop
+            frame = caller
+
+        if frame is None:
+            caller = "unknown"
+        else:
+            caller = "{}:{}".format(frame.f_globals.get("__name__"), frame.f_code.co_name)
+
+        with self._metrics_lock:
+            self._metrics_tainted_by[caller] += 1
+
+    def _metrics_record(self, kind, **values):
+        """called from the writer thread (and backends), values are seconds or counts"""
+        values["kind"] = kind
+        values["time"] = time.time()
+        with self._metrics_lock:
+            self._metrics_saves.append(values)
+            self._metrics_totals[kind] += 1
+            for name in ("bytes", "files", "serialise", "backup", "fsync", "total"):
+                if name in values:
+                    self._metrics_totals["{}_{}".format(kind, name)] += values[name]
+
+    def metrics(self):
+        """json-compatible summary of persistence activity"""
+        with self._metrics_lock:
+            return { "filename": self.filename,
+                     "load": dict(self._metrics_load),
+                     "totals": dict(self._metrics_totals),
+                     "recent": [ dict(save) for save in self._metrics_saves ],
+                     "tainted_by": dict(self._metrics_tainted_by),
+                     "suboption_cache": self.suboption_cache_info() }
+
+    def checksum(self):
+        """crc32 over the files the tree was last read from or written to
+        None if the tree has changes that are not on disk yet, callers use this to tell
+        whether anything derived from the tree is still valid"""
+        if self.changed or self._timer_save is not None or self._journal_records or self._journal_pending:
+            return None
+
+        self._writer_wait()
+
+        filenames = [ self.filename ] + [ self._shard_filename(key) for key in sorted(self._shard_keys_on_disk) ]
+        checksums = [ self._failsafe_checksums.get(filename) for filename in filenames ]
+        if None in checksums:
+            return None
+
+        return zlib.crc32(repr(list(zip(filenames, checksums))).encode("utf-8"))
+
+    def _writer_submit(self, function, *args):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1)
+        future = self._writer.submit(function, *args)
+        self._writer_futures.add(future)
+        future.add_done_callback(self._writer_done)
+        return future
+
+    def _writer_done(self, future):
+        """runs on the writer thread, the result is handled on the event loop"""
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._writer_completed, future)
+
+    def _writer_completed(self, future):
+        """runs on the event loop, a future already collected by _writer_wait() is ignored"""
+        if future in self._writer_futures:
+            self._writer_futures.discard(future)
+            if future.exception() is not None:
+                self._writer_failed(future.exception())
+
+    def _writer_failed(self, exception):
+        logger.error("{} write failed".format(self.filename), exc_info=exception)
+        self._writer_exception = exception
+        # retry with the next save
+        self.force_taint()
+
+    def _writer_wait(self):
+        """block until all submitted writes have completed, failures are handled right away"""
+        if self._writer is not None:
+            self._writer.submit(lambda: None).result()
+
+        futures, self._writer_futures = self._writer_futures, set()
+        for future in futures:
+            if future.exception() is not None:
+                self._writer_failed(future.exception())
+
+    def _serialise(self, value):
+        """runs on the event loop, see compact"""
+        if self.compact:
+            return json.dumps(value, separators=(',', ':'), sort_keys=True, default=json_default)
+        return json.dumps(value, indent=2, sort_keys=True, default=json_default)
+
+    def _take_snapshot(self):
+        """runs on the caller (event loop) thread: serialise what the writer needs
+        only dirty keys are serialised again, every parsed key after force_taint(). the main file
+        reuses the fragments of its clean keys. the snapshot only holds text, later changes to
+        the tree cannot reach a write in progress"""
+        start_time = time.time()
+
+        keys = self._persisted_keys()
+        main_keys = { key for key in keys if not self._is_shard(key) }
+        shard_keys = keys - main_keys
+
+        dirty = keys if self._dirty_all else self._dirty & keys
+        if isinstance(self.config, _LazyTree) and self.config.pending:
+            # values that were never parsed cannot have changed, their mapped text is still current
+            dirty = dirty - (self.config.pending & self._fragments.keys() & main_keys)
+
+        for key in self._fragments.keys() - main_keys:
+            del self._fragments[key]
+
+        serialised = 0
+        main = None
+        if dirty & main_keys or main_keys != self._written_main_keys:
+            for key in main_keys:
+                if key in dirty or key not in self._fragments:
+                    self._fragments[key] = _fragment(self._serialise(self.config[key]))
+                    serialised = serialised + 1
+                elif type(self._fragments[key]) is _Span:
+                    # decode the mapped text once, so the mapping of a replaced file can be released
+                    self._fragments[key] = str(self._fragments[key])
+            main = [ (key, self._fragments[key]) for key in sorted(main_keys) ]
+            self._written_main_keys = main_keys
+
+        shards = [ (key, self._serialise(self.config[key])) for key in sorted(dirty & shard_keys) ]
+        serialised = serialised + len(shards)
+
+        snapshot = { "main": main,
+                     "shards": shards,
+                     "remove": self._shard_keys_on_disk - shard_keys,
+                     "keys": serialised,
+                     "serialise": time.time() - start_time }
+
+        self._shard_keys_on_disk = (self._shard_keys_on_disk & shard_keys) | { key for key, text in shards }
+
+        self._dirty = set()
+        self._dirty_all = False
+
+        return snapshot
+
+    def _write_file(self, filename, text, timings):
+        """runs on the writer thread: atomically replace a file, adding to timings"""
+        raw = text.encode("utf-8")
+
+        start_time = time.time()
+        if self.failsafe_backups:
+            self._make_failsafe_backup(filename, len(raw))
+        backup_time = time.time() - start_time
+
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            fsync_start = time.time()
+            os.fsync(f.fileno())
+            fsync_time = time.time() - fsync_start
+        os.replace(temp_filename, filename)
+
+        self._failsafe_checksums[filename] = zlib.crc32(raw)
+
+        timings["bytes"] += len(raw)
+        timings["files"] += 1
+        timings["backup"] += backup_time
+        timings["fsync"] += fsync_time
+        timings["io"] += time.time() - start_time
+
+    def _write_snapshot(self, snapshot):
+        """runs on the writer thread: write the files of a snapshot taken by _take_snapshot()
+        order matters for crash safety: keys moving into a shard are written there before
+        leaving the main file, stale shard files are removed after the main file is written"""
+        start_time = time.time()
+        timings = collections.Counter()
+
+        if snapshot["shards"]:
+            os.makedirs(self._shards_path, exist_ok=True)
+        for key, text in snapshot["shards"]:
+            self._write_file(self._shard_filename(key), text, timings)
+
+        if snapshot["main"] is not None:
+            if snapshot["main"]:
+                text = "{\n" + ",\n".join([ "  {}: {}".format(json.dumps(key), fragment)
+                                              for key, fragment in snapshot["main"] ]) + "\n}"
+            else:
+                text = "{}"
+            self._write_file(self.filename, text, timings)
+
+        for key in snapshot["remove"]:
+            try:
+                os.remove(self._shard_filename(key))
+            except OSError:
+                pass
+
+        if self.journal:
+            # snapshot now contains every journalled change
+            self._journal_remove()
+
+        interval = time.time() - start_time
+
+        self._metrics_record("snapshot", bytes=timings["bytes"], files=timings["files"], keys=snapshot["keys"],
+                             serialise=snapshot["serialise"], backup=timings["backup"],
+                             fsync=timings["fsync"], total=snapshot["serialise"] + interval)
+
+        logger.info("{} write {} shard(s){} {}".format(
+            self.filename, len(snapshot["shards"]), "" if snapshot["main"] is None else " + main", interval))
+
+    def _schedule_save(self):
+        """runs on the event loop: restart the save_delay countdown"""
+        if self._timer_save is not None:
+            self._timer_save.cancel()
+            with self._metrics_lock:
+                self._metrics_totals["coalesced"] += 1
+        self._timer_save = self._loop.call_later(self.save_delay, self._save_timer)
+
+    def _save_timer(self):
+        self._timer_save = None
+        self.save(False)
 
     def save(self, delay=True):
         if self.save_delay:
             if delay:
-                if self._timer_save and self._timer_save.is_alive():
-                    self._timer_save.cancel()
-                self._timer_save = Timer(self.save_delay, self.save, [], {"delay": False})
-                self._timer_save.start()
+                # coalesce saves on the event loop, safe to call from other threads
+                with self._metrics_lock:
+                    self._metrics_totals["save_requests"] += 1
+                self._loop.call_soon_threadsafe(self._schedule_save)
                 return False
 
-        """Save config to file (only if config has changed)"""
+        """Save config to file (only if config has changed)
+        changed keys are serialised here, on the caller (event loop) thread,
+        disk i/o happens on the writer thread"""
         if self.changed:
-            start_time = time.time()
+            self.changed = False
 
-            if self.failsafe_backups:
-                self._make_failsafe_backup()
+            if self.journal and self._journal_flush():
+                return self.changed
 
-            with open(self.filename, 'w') as f:
-                json.dump(self.config, f, indent=2, sort_keys=True)
-                self.changed = False
-            interval = time.time() - start_time
+            self._journal_pending = collections.OrderedDict()
+            self._journal_records = 0
+            self._journal_snapshot_required = False
 
-            logger.info("{} write {}".format(self.filename, interval))
+            snapshot = self._take_snapshot()
+            if snapshot["main"] is not None or snapshot["shards"] or snapshot["remove"] or self.journal:
+                self._writer_submit(self._write_snapshot, snapshot)
 
         return self.changed
 
     def flush(self):
-        if self._timer_save and self._timer_save.is_alive():
+        if self._timer_save is not None:
             logger.info("flushing {}".format(self.filename))
             self._timer_save.cancel()
+            self._timer_save = None
+
+        if self.journal and (self._journal_records or self._journal_pending):
+            # fold the journal into the snapshot on shutdown
+            self.force_taint()
+
         self.save(delay=False)
+        self._writer_wait()
+
+        if self._writer_exception is not None:
+            exception, self._writer_exception = self._writer_exception, None
+            raise exception
 
     def get_by_path(self, keys_list):
-        """Get item from config by path (list of keys)"""
-        return functools.reduce(lambda d, k: d[int(k) if isinstance(d, list) else k], keys_list, self)
+        """Get item from config by path (list or tuple of keys)"""
+        node = self
+        for k in keys_list:
+            node = node[int(k) if isinstance(node, list) else k]
+        return node
+
+    def _walk(self, keys_list):
+        """single pass lookup, returns _MISSING instead of raising on an absent path
+        a missing top-level key resolves to self.default, as with __getitem__"""
+        if not keys_list:
+            return self
+        node = self.config.get(keys_list[0], self.default)
+        for k in keys_list[1:]:
+            if type(node) is dict:
+                node = node.get(k, _MISSING)
+                if node is _MISSING:
+                    return _MISSING
+            elif isinstance(node, list):
+                try:
+                    node = node[int(k)]
+                except (ValueError, IndexError):
+                    return _MISSING
+            elif isinstance(node, collections.MutableMapping):
+                node = node.get(k, _MISSING)
+                if node is _MISSING:
+                    return _MISSING
+            else:
+                return _MISSING
+        return node
+
+    def get_or_default(self, keys_list, default=None):
+        """get item by path, or default if any part of the path does not exist"""
+        value = self._walk(keys_list)
+        if value is _MISSING:
+            return default
+        return value
+
+    def _get_parent(self, keys_list):
+        """container holding the last key of the path, bypassing the journalled top-level accessors"""
+        parent = self.get_by_path(keys_list[:-1])
+        if parent is self:
+            parent = self.config
+        return parent
 
     def set_by_path(self, keys_list, value):
         """Set item in config by path (list of keys)"""
-        self.get_by_path(keys_list[:-1])[keys_list[-1]] = value
-        self.changed = True
+        self._get_parent(keys_list)[keys_list[-1]] = value
+        self._taint(keys_list[0])
+        self._journal_append(keys_list)
 
     def pop_by_path(self, keys_list):
-        popped_value = self.get_by_path(keys_list[:-1]).pop(keys_list[-1])
-        self.changed = True
+        popped_value = self._get_parent(keys_list).pop(keys_list[-1])
+        self._taint(keys_list[0])
+        self._journal_append(keys_list)
         return popped_value
 
+    def record_fields(self, key, paths):
+        """[ (id, [ value at each path, None if absent ]) ] for every record of a top-level mapping
+        e.g. record_fields("user_data", [("1on1",)]), storage backends may answer this
+        without materialising the records"""
+        records = self.get_or_default((key,))
+        if not isinstance(records, collections.MutableMapping):
+            return []
+        return [ (id, [ _field(record, path) for path in paths ]) for id, record in records.items() ]
+
     def get_option(self, keyname):
         try:
             value = self.config[keyname]
@@ -131,22 +961,39 @@ class Config(collections.MutableMapping):
         return value
 
     def get_suboption(self, grouping, groupname, keyname):
+        cache_key = (grouping, groupname, keyname)
+        try:
+            value = self._suboption_cache[cache_key]
+            self.suboption_cache_hits += 1
+            return value
+        except KeyError:
+            self.suboption_cache_misses += 1
+
         try:
             value = self.config[grouping][groupname][keyname]
         except KeyError:
             value = self.get_option(keyname)
+
+        # result depends on config[grouping] and the config[keyname] fallback
+        self._suboption_cache[cache_key] = value
+        self._suboption_dependents.setdefault(grouping, set()).add(cache_key)
+        self._suboption_dependents.setdefault(keyname, set()).add(cache_key)
+
         return value
 
-    def exists(self, keys_list):
-        _exists = True
+    def _suboption_cache_clear(self):
+        self._suboption_cache = {}
+        self._suboption_dependents = {}
+        self.version += 1
 
-        try:
-            if self.get_by_path(keys_list) is None:
-                _exists = False
-        except (KeyError, TypeError):
-            _exists = False
+    def suboption_cache_info(self):
+        return { "hits": self.suboption_cache_hits,
+                 "misses": self.suboption_cache_misses,
+                 "size": len(self._suboption_cache) }
 
-        return _exists
+    def exists(self, keys_list):
+        value = self._walk(keys_list)
+        return value is not _MISSING and value is not None
 
     def __getitem__(self, key):
         try:
@@ -156,11 +1003,13 @@ class Config(collections.MutableMapping):
 
     def __setitem__(self, key, value):
         self.config[key] = value
-        self.changed = True
+        self._taint(key)
+        self._journal_append([key])
 
     def __delitem__(self, key):
         del self.config[key]
-        self.changed = True
+        self._taint(key)
+        self._journal_append([key])
 
     def __iter__(self):
         return iter(self.config)
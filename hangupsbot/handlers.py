@@ -1,4 +1,7 @@
+import collections
+import itertools
 import logging
+import re
 import shlex
 import asyncio
 import inspect
@@ -13,6 +16,90 @@ from commands import command
 logger = logging.getLogger(__name__)
 
 
+"""registered handler, everything run_pluggable_omnibus() needs is resolved at registration
+indexes 0-2 are (function, priority, plugin metadata) as before"""
+HandlerRecord = collections.namedtuple("HandlerRecord", "function priority metadata arity coroutine label timeout filters")
+
+"""register_handler() filters after validation, see compile_filters()"""
+HandlerFilters = collections.namedtuple("HandlerFilters", "conv_ids conv_tags config prefix text subtypes")
+
+"""subtype of the event types that support the subtypes filter"""
+_SUBTYPES = { "call": lambda event: event.conv_event._event.hangout_event.event_type,
+              "membership": lambda event: event.conv_event.type_,
+              "typing": lambda event: event.conv_event.status }
+
+"""event types without message text, prefix and text filters are rejected for them:
+call, membership and rename events have an empty text, typing and watermark events a fixed
+placeholder ("typing", "watermark" in event.py), a filter would match every event of the type or none"""
+_TEXTLESS = frozenset(["call", "membership", "rename", "typing", "watermark"])
+
+
+_ARGUMENT = re.compile(r"[^ \t\r\n]+") # shlex whitespace
+
+
+def split_arguments(text):
+    """shlex.split(text, posix=False), without the shlex machinery if text has no quotes"""
+    if '"' in text or "'" in text:
+        return shlex.split(text, posix=False)
+    return _ARGUMENT.findall(text)
+
+
+def _subtype_name(subtype):
+    """hangups enum member or its name, e.g. hangups.MembershipChangeType.JOIN or "JOIN" """
+    return getattr(subtype, "name", subtype)
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+def compile_filters(type, filters):
+    """validate the filters of a handler, it only runs if every supplied filter matches:
+        conv_ids: list of conversation ids
+        conv_tags: list of tags, the conversation must carry at least one of them
+        config: list of config keys, each must be set for the conversation
+        prefix: the event text starts with the string (or one of a list of strings)
+        text: regex (pattern or compiled) found anywhere in the event text
+            prefix and text are rejected for event types without message text, see _TEXTLESS
+        subtypes: e.g. ["JOIN"] for membership, ["STARTED"] for typing, ["END_HANGOUT"] for call
+    returns None for an empty filter"""
+    if not filters:
+        return None
+
+    if type == "sending":
+        raise ValueError("{} handlers cannot be filtered".format(type))
+
+    unknown = set(filters) - set(HandlerFilters._fields)
+    if unknown:
+        raise ValueError("unknown handler filter(s): {}".format(", ".join(sorted(unknown))))
+
+    if type in _TEXTLESS:
+        textual = [ key for key in ("prefix", "text") if filters.get(key) is not None ]
+        if textual:
+            raise ValueError("{} events have no message text to filter by {}".format(type, ", ".join(textual)))
+
+    subtypes = filters.get("subtypes")
+    if subtypes is not None:
+        if type not in _SUBTYPES:
+            raise ValueError("{} events have no subtypes".format(type))
+        subtypes = frozenset(_subtype_name(subtype) for subtype in _as_list(subtypes))
+
+    text = filters.get("text")
+    if isinstance(text, str):
+        text = re.compile(text)
+
+    conv_ids = filters.get("conv_ids")
+    conv_tags = filters.get("conv_tags")
+    prefix = filters.get("prefix")
+
+    return HandlerFilters( None if conv_ids is None else frozenset(_as_list(conv_ids)),
+                           None if conv_tags is None else frozenset(_as_list(conv_tags)),
+                           tuple(_as_list(filters.get("config") or [])),
+                           None if prefix is None else tuple(_as_list(prefix)),
+                           text,
+                           subtypes )
+
+
 class EventHandler:
     """Handle Hangups conversation events"""
 
@@ -23,6 +110,12 @@ class EventHandler:
         self._prefix_reprocessor = "uuid://"
         self._reprocessors = {}
 
+        """handlers whose conversation filters pass, per (type, conv_id), see _select_handlers()"""
+        self._version = 0 # incremented by invalidate()
+        self._filter_versions = None
+        self._filter_cache = {}
+        self._filtered_types = frozenset()
+
         self.pluggables = { "allmessages": [],
                             "call": [],
                             "membership": [],
@@ -37,8 +130,44 @@ class EventHandler:
                              forgiving=True )
 
 
-    def register_handler(self, function, type="message", priority=50):
-        """registers extra event handlers"""
+    @property
+    def bot_command(self):
+        """list of bot aliases, e.g. [ "/bot" ]"""
+        return self._bot_command
+
+    @bot_command.setter
+    def bot_command(self, aliases):
+        if not isinstance(aliases, list):
+            aliases = [aliases]
+        self._bot_command = aliases
+        self._compile_bot_command()
+
+    def _compile_bot_command(self):
+        """single regex over all aliases, matched against the start of every message
+        the first word must equal an alias after lowercasing, as with the previous split() check"""
+        self._bot_command_compiled = list(self._bot_command)
+        self._bot_command_set = frozenset(self._bot_command)
+        patterns = sorted({ re.escape(alias) for alias in self._bot_command if alias }, key=len, reverse=True)
+        if patterns:
+            self._bot_command_regex = re.compile(r"\s*({})(?:\s|$)".format("|".join(patterns)), re.IGNORECASE)
+        else:
+            self._bot_command_regex = None
+
+    def match_bot_command(self, text):
+        """True if text starts with a bot alias"""
+        if self._bot_command != self._bot_command_compiled:
+            # the alias list was modified in-place
+            self._compile_bot_command()
+        if self._bot_command_regex is None:
+            return False
+        match = self._bot_command_regex.match(text)
+        return match is not None and match.group(1).lower() in self._bot_command_set
+
+
+    def register_handler(self, function, type="message", priority=50, timeout=None, filters=None):
+        """registers extra event handlers
+        a coroutine handler running longer than timeout seconds is cancelled
+        filters (dict, see compile_filters()) skip the handler for events it would ignore anyway"""
         if type in ["allmessages", "call", "membership", "message", "rename", "typing", "watermark"]:
             if not asyncio.iscoroutine(function):
                 # transparently convert into coroutine
@@ -50,11 +179,79 @@ class EventHandler:
             raise ValueError("unknown event type for handler: {}".format(type))
 
         current_plugin = plugins.tracking.current()
-        self.pluggables[type].append((function, priority, current_plugin["metadata"]))
+        self.pluggables[type].append(self.handler_record(function, type, priority, current_plugin["metadata"], timeout, filters))
         self.pluggables[type].sort(key=lambda tup: tup[1])
+        self.invalidate()
 
         plugins.tracking.register_handler(function, type, priority)
 
+    @staticmethod
+    def handler_record(function, type, priority, plugin_metadata, timeout=None, filters=None):
+        """accepted handler signatures:
+        coroutine(bot, event, command)
+        coroutine(bot, event)
+        function(bot, event, context)
+        function(bot, event)
+        """
+        return HandlerRecord( function,
+                              priority,
+                              plugin_metadata,
+                              len(inspect.signature(function).parameters),
+                              asyncio.iscoroutinefunction(function),
+                              "{}: {}.{}".format(type, plugin_metadata["module.path"], function.__name__),
+                              timeout,
+                              compile_filters(type, filters) )
+
+    def invalidate(self):
+        """drop the filtered handler index, call after modifying pluggables directly
+        changes to config and tags are picked up without it"""
+        self._version += 1
+
+    def _select_handlers(self, name, event):
+        """snapshot of the handlers of an event type that can match the event
+        conversation filters are resolved once per (type, conv_id) until handlers, config or tags change,
+        prefix, text and subtypes filters are checked for every event"""
+        versions = (self._version, self.bot.config.version, self.bot.tags.version)
+        if versions != self._filter_versions:
+            self._filter_versions = versions
+            self._filter_cache = {}
+            self._filtered_types = frozenset( type for type, handlers in self.pluggables.items()
+                                              if any(handler.filters for handler in handlers) )
+
+        if name not in self._filtered_types:
+            return list(self.pluggables[name])
+
+        key = (name, event.conv_id)
+        handlers = self._filter_cache.get(key)
+        if handlers is None:
+            handlers = self._filter_cache[key] = tuple(
+                handler for handler in self.pluggables[name]
+                if handler.filters is None or self._conversation_matches(handler.filters, event.conv_id) )
+
+        return [ handler for handler in handlers
+                 if handler.filters is None or self._event_matches(handler.filters, name, event) ]
+
+    def _conversation_matches(self, filters, conv_id):
+        if filters.conv_ids is not None and conv_id not in filters.conv_ids:
+            return False
+        if filters.conv_tags is not None and filters.conv_tags.isdisjoint(
+                self.bot.tags.indices["conv-tags"].get(conv_id, ())):
+            return False
+        for key in filters.config:
+            if not self.bot.get_config_suboption(conv_id, key):
+                return False
+        return True
+
+    @staticmethod
+    def _event_matches(filters, name, event):
+        if filters.subtypes is not None and _subtype_name(_SUBTYPES[name](event)) not in filters.subtypes:
+            return False
+        if filters.prefix is not None and not event.text.startswith(filters.prefix):
+            return False
+        if filters.text is not None and not filters.text.search(event.text):
+            return False
+        return True
+
     def register_reprocessor(self, callable):
         _id = str(uuid.uuid4())
         self._reprocessors[_id] = callable
@@ -135,11 +332,10 @@ class EventHandler:
 
             """auto opt-in - opted-out users who chat with the bot will be opted-in again"""
             if self.bot.conversations.catalog[event.conv_id]["type"] == "ONE_TO_ONE":
-                if self.bot.memory.exists(["user_data", event.user.id_.chat_id, "optout"]):
-                    if self.bot.memory.get_by_path(["user_data", event.user.id_.chat_id, "optout"]):
-                        yield from command.run(self.bot, event, *["optout"])
-                        logger.info("auto opt-in for {}".format(event.user.id_.chat_id))
-                        return
+                if self.bot.memory.get_or_default(("user_data", event.user.id_.chat_id, "optout")):
+                    yield from command.run(self.bot, event, *["optout"])
+                    logger.info("auto opt-in for {}".format(event.user.id_.chat_id))
+                    return
 
             yield from self.run_pluggable_omnibus("allmessages", self.bot, event, command)
             if not event.from_bot:
@@ -150,6 +346,10 @@ class EventHandler:
     def handle_command(self, event):
         """Handle command messages"""
 
+        # check that a bot alias is used e.g. /bot, before any config or tag lookups
+        if not self.match_bot_command(event.text):
+            return
+
         # is commands_enabled?
 
         config_commands_enabled = self.bot.get_config_suboption(event.conv_id, 'commands_enabled')
@@ -161,18 +361,10 @@ class EventHandler:
             if event.user_id.chat_id not in admins_list:
                 return
 
-        # ensure bot alias is always a list
-        if not isinstance(self.bot_command, list):
-            self.bot_command = [self.bot_command]
-
-        # check that a bot alias is used e.g. /bot
-        if not event.text.split()[0].lower() in self.bot_command:
-            return
-
         # Parse message
         event.text = event.text.replace(u'\xa0', u' ') # convert non-breaking space in Latin1 (ISO 8859-1)
         try:
-            line_args = shlex.split(event.text, posix=False)
+            line_args = split_arguments(event.text)
         except Exception as e:
             logger.exception(e)
             yield from self.bot.coro_send_message(event.conv, _("{}: {}").format(
@@ -234,53 +426,84 @@ class EventHandler:
         """handle conversation name change"""
         yield from self.run_pluggable_omnibus("watermark", self.bot, event, command)
 
+    def _concurrent_types(self):
+        """event types whose same-priority handlers run concurrently, config.json:
+            "handlers-concurrent": true # message and allmessages handlers
+            "handlers-concurrent": [ "message", "membership", ... ]
+        sending handlers always run in sequence, they modify the outgoing message in order"""
+        option = self.bot.get_config_option("handlers-concurrent")
+        if option is True:
+            return ("allmessages", "message")
+        if isinstance(option, list):
+            return [ type for type in option if type != "sending" ]
+        return ()
+
     @asyncio.coroutine
     def run_pluggable_omnibus(self, name, *args, **kwargs):
+        """run the handlers of an event type in priority order
+        SuppressHandler skips the raising handler, SuppressAllHandlers skips all following
+        handlers and SuppressEventHandling additionally propagates to the caller
+        in concurrent mode each priority tier runs at once: every handler in the tier
+        completes, then a SuppressAllHandlers/SuppressEventHandling raised by any of them
+        applies to the following tiers
+        handlers whose filters cannot match the event (args[1]) are skipped"""
         if name in self.pluggables:
+            debug = logger.isEnabledFor(logging.DEBUG)
+            handlers = self._select_handlers(name, args[1])
             try:
-                for function, priority, plugin_metadata in self.pluggables[name]:
-                    message = ["{}: {}.{}".format(
-                                name,
-                                plugin_metadata["module.path"],
-                                function.__name__)]
-
-                    try:
-                        """accepted handler signatures:
-                        coroutine(bot, event, command)
-                        coroutine(bot, event)
-                        function(bot, event, context)
-                        function(bot, event)
-                        """
-                        _expected = list(inspect.signature(function).parameters)
-                        _passed = args[0:len(_expected)]
-                        if asyncio.iscoroutinefunction(function):
-                            message.append("coroutine")
-                            logger.debug(" : ".join(message))
-                            yield from function(*_passed)
-                        else:
-                            message.append("function")
-                            logger.debug(" : ".join(message))
-                            function(*_passed)
-                    except self.bot.Exceptions.SuppressHandler:
-                        # skip this pluggable, continue with next
-                        message.append("SuppressHandler")
-                        logger.debug(" : ".join(message))
-                        pass
-                    except (self.bot.Exceptions.SuppressEventHandling,
-                            self.bot.Exceptions.SuppressAllHandlers):
-                        # skip all pluggables, decide whether to handle event at next level
-                        raise
-                    except:
-                        message = " : ".join(message)
-                        logger.exception(message)
+                if name in self._concurrent_types():
+                    for priority, tier in itertools.groupby(handlers, key=lambda handler: handler.priority):
+                        tier = list(tier)
+                        if len(tier) == 1:
+                            yield from self._run_handler(tier[0], args, debug)
+                            continue
+
+                        results = yield from asyncio.gather(
+                            *[ self._run_handler(handler, args, debug) for handler in tier ],
+                            return_exceptions=True)
+
+                        for suppress in (self.bot.Exceptions.SuppressEventHandling,
+                                         self.bot.Exceptions.SuppressAllHandlers):
+                            for result in results:
+                                if isinstance(result, suppress):
+                                    raise result
+                else:
+                    for handler in handlers:
+                        yield from self._run_handler(handler, args, debug)
 
             except self.bot.Exceptions.SuppressAllHandlers:
                 # skip all other pluggables, but let the event continue
-                message.append("SuppressAllHandlers")
-                logger.debug(" : ".join(message))
+                if debug:
+                    logger.debug("{} : SuppressAllHandlers".format(name))
 
-            except:
-                raise
+    @asyncio.coroutine
+    def _run_handler(self, handler, args, debug):
+        """run one handler, only SuppressEventHandling and SuppressAllHandlers are raised"""
+        try:
+            _passed = args[0:handler.arity]
+            if handler.coroutine:
+                if debug:
+                    logger.debug("{} : coroutine".format(handler.label))
+                if handler.timeout:
+                    yield from asyncio.wait_for(handler.function(*_passed), handler.timeout)
+                else:
+                    yield from handler.function(*_passed)
+            else:
+                if debug:
+                    logger.debug("{} : function".format(handler.label))
+                handler.function(*_passed)
+        except self.bot.Exceptions.SuppressHandler:
+            # skip this pluggable, continue with next
+            if debug:
+                logger.debug("{} : SuppressHandler".format(handler.label))
+        except (self.bot.Exceptions.SuppressEventHandling,
+                self.bot.Exceptions.SuppressAllHandlers):
+            # skip all pluggables, decide whether to handle event at next level
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("{} : cancelled after {}s".format(handler.label, handler.timeout))
+        except:
+            logger.exception(handler.label)
 
 class HandlerBridge:
     """shim for xmikosbot handler decorator"""
@@ -45,7 +45,9 @@ class HangupsBot(object):
         # These are populated by on_connect when it's called.
         self._conv_list = None # hangups.ConversationList
         self._user_list = None # hangups.UserList
+        self._lists_client = None # hangups.Client the lists above were built for
         self._handlers = None # handlers.py::EventHandler
+        self.conversations = None # permamem.py::conversation_memory, kept across reconnects
 
         self._cache_event_id = {} # workaround for duplicate events
 
@@ -67,17 +69,37 @@ class HangupsBot(object):
         self.memory = None
         if memory_file:
             _failsafe_backups = int(self.get_config_option('memory-failsafe_backups') or 3)
+            _failsafe_interval = int(self.get_config_option('memory-failsafe_interval') or 300)
+            _failsafe_size = int(self.get_config_option('memory-failsafe_size') or 0)
             _save_delay = int(self.get_config_option('memory-save_delay') or 1)
-
-            logger.info("memory = {}, failsafe = {}, delay = {}".format(
-                memory_file, _failsafe_backups, _save_delay))
-
-            self.memory = config.Config(memory_file, failsafe_backups=_failsafe_backups, save_delay=_save_delay)
+            _journal = bool(self.get_config_option('memory-journal'))
+            _journal_compact = int(self.get_config_option('memory-journal_compact') or 1000)
+            _shards = self.get_config_option('memory-shards')
+            _lazy = bool(self.get_config_option('memory-lazy_load'))
+
+            logger.info("memory = {}, failsafe = {}, delay = {}, journal = {}".format(
+                memory_file, _failsafe_backups, _save_delay, _journal_compact if _journal else False))
+
+            _memory_class = config.Config
+            if self.get_config_option('memory-backend') == "sqlite":
+                import memory_sqlite
+                _memory_class = memory_sqlite.SQLiteConfig
+
+            self.memory = _memory_class(memory_file,
+                                        failsafe_backups=_failsafe_backups,
+                                        save_delay=_save_delay,
+                                        journal=_journal,
+                                        journal_compact=_journal_compact,
+                                        shards=_shards,
+                                        failsafe_interval=_failsafe_interval,
+                                        failsafe_size=_failsafe_size,
+                                        lazy=_lazy,
+                                        compact=True)
             if not os.path.isfile(memory_file):
                 try:
                     logger.info("creating memory file: {}".format(memory_file))
                     self.memory.force_taint()
-                    self.memory.save()
+                    self.memory.flush()
 
                 except (OSError, IOError) as e:
                     logger.exception('FAILED TO CREATE DEFAULT MEMORY FILE')
@@ -170,6 +192,9 @@ class HangupsBot(object):
                     self.memory.flush()
                     self.config.flush()
 
+                    if self.conversations is not None:
+                        self.conversations.save_warm_start()
+
                     sys.exit(0)
                 except Exception as e:
                     logger.exception("CLIENT: unrecoverable low-level error")
@@ -294,9 +319,8 @@ class HangupsBot(object):
 
         """from permanent conversation user/memory"""
         if not hangups_user:
-            if self.memory.exists(["user_data", chat_id, "_hangups"]):
-                _cached = self.memory.get_by_path(["user_data", chat_id, "_hangups"])
-
+            _cached = self.memory.get_or_default(("user_data", chat_id, "_hangups"))
+            if _cached:
                 hangups_user = hangups.user.User(
                     UserID, 
                     _cached["full_name"],
@@ -348,8 +372,12 @@ class HangupsBot(object):
         return self.memory.get_suboption("user_data", user_id, option)
 
     def user_memory_set(self, chat_id, keyname, keyvalue):
-        self.initialise_memory(chat_id, "user_data")
-        self.memory.set_by_path(["user_data", chat_id, keyname], keyvalue)
+        if keyname == "1on1" and self.conversations is not None:
+            # keep the 1-to-1 index current, it is built from memory on connect
+            self.conversations.set_1on1(chat_id, keyvalue)
+        else:
+            self.initialise_memory(chat_id, "user_data")
+            self.memory.set_by_path(["user_data", chat_id, keyname], keyvalue)
         self.memory.save()
 
     def user_memory_get(self, chat_id, keyname):
@@ -382,35 +410,40 @@ class HangupsBot(object):
             for u in c.users:
                 print('    {} ({}) {}'.format(u.first_name, u.full_name, u.id_.chat_id))
 
+    def _get_1on1_id(self, chat_id):
+        """remembered 1-to-1 conversation id, read from memory until the index is built on connect"""
+        if self.conversations is None:
+            return self.memory.get_or_default(("user_data", chat_id, "1on1")) or None
+        return self.conversations.get_1on1_id(chat_id)
+
+    def _search_1on1(self, chat_id):
+        """known 1-to-1 conversation id, None before connect (no conversations are known yet)"""
+        if self.conversations is None:
+            return None
+        return self.conversations.search_1on1(chat_id)
+
     def get_1on1_conversation(self, chat_id):
         """find a 1-to-1 conversation with specified user
         maintained for functionality with older plugins that do not use get_1to1()
         """
         logger.warning('[DEPRECATED]: yield from bot.get_1to1(chat_id), instead of bot.get_1on1_conversation(chat_id)')
 
-        if self.memory.exists(["user_data", chat_id, "optout"]):
-            if self.memory.get_by_path(["user_data", chat_id, "optout"]):
-                return False
+        if self.memory.get_or_default(("user_data", chat_id, "optout")):
+            return False
 
         conversation = None
 
-        if self.memory.exists(["user_data", chat_id, "1on1"]):
-            conversation_id = self.memory.get_by_path(["user_data", chat_id, "1on1"])
+        conversation_id = self._get_1on1_id(chat_id)
+        if conversation_id is not None:
             conversation = FakeConversation(self._client, conversation_id)
             logger.info(_("memory: {} is 1on1 with {}").format(conversation_id, chat_id))
         else:
-            for c in self.list_conversations():
-                if len(c.users) == 2:
-                    for u in c.users:
-                        if u.id_.chat_id == chat_id:
-                            conversation = c
-                            break
+            conversation_id = self._search_1on1(chat_id)
+            if conversation_id is not None:
+                conversation = self.get_hangups_conversation(conversation_id)
 
-            if conversation is not None:
                 # remember the conversation so we don't have to do this again
-                self.initialise_memory(chat_id, "user_data")
-                self.memory.set_by_path(["user_data", chat_id, "1on1"], conversation.id_)
-                self.memory.save()
+                self.user_memory_set(chat_id, "1on1", conversation.id_)
 
         return conversation
 
@@ -423,15 +456,14 @@ class HangupsBot(object):
             is created - "{0}" will be substituted with first bot alias
         """
 
-        if self.memory.exists(["user_data", chat_id, "optout"]):
-            if self.memory.get_by_path(["user_data", chat_id, "optout"]):
-                logger.info("get_1on1: user {} has optout".format(chat_id))
-                return False
+        if self.memory.get_or_default(("user_data", chat_id, "optout")):
+            logger.info("get_1on1: user {} has optout".format(chat_id))
+            return False
 
         conversation = None
 
-        if self.memory.exists(["user_data", chat_id, "1on1"]):
-            conversation_id = self.memory.get_by_path(["user_data", chat_id, "1on1"])
+        conversation_id = self._get_1on1_id(chat_id)
+        if conversation_id is not None:
             conversation = FakeConversation(self._client, conversation_id)
             logger.info("get_1on1: remembered {} for {}".format(conversation_id, chat_id))
         else:
@@ -460,19 +492,14 @@ class HangupsBot(object):
                 a chat invite only - a message sent on the channel auto-accepts the invite)
                 """
                 logger.info("get_1on1: searching for existing 1to1 with {}".format(chat_id))
-                for c in self.list_conversations():
-                    if len(c.users) == 2:
-                        for u in c.users:
-                            if u.id_.chat_id == chat_id:
-                                conversation = c
-                                break
+                conversation_id = self._search_1on1(chat_id)
+                if conversation_id is not None:
+                    conversation = self.get_hangups_conversation(conversation_id)
 
             if conversation is not None:
                 # remember the conversation so we don't have to do this again
                 logger.info("get_1on1: determined {} for {}".format(conversation.id_, chat_id))
-                self.initialise_memory(chat_id, "user_data")
-                self.memory.set_by_path(["user_data", chat_id, "1on1"], conversation.id_)
-                self.memory.save()
+                self.user_memory_set(chat_id, "1on1", conversation.id_)
 
         return conversation
 
@@ -480,12 +507,12 @@ class HangupsBot(object):
     def initialise_memory(self, chat_id, datatype):
         modified = False
 
-        if not self.memory.exists([datatype]):
+        if not self.memory.exists((datatype,)):
             # create the datatype grouping if it does not exist
             self.memory.set_by_path([datatype], {})
             modified = True
 
-        if not self.memory.exists([datatype, chat_id]):
+        if not self.memory.exists((datatype, chat_id)):
             # create the memory
             self.memory.set_by_path([datatype, chat_id], {})
             modified = True
@@ -518,13 +545,19 @@ class HangupsBot(object):
 
         plugins.load(self, "monkeypatch.otr_support")
 
-        self._user_list = yield from hangups.user.build_user_list(self._client,
-                                                                  initial_data)
+        rebuild = self._lists_client is not self._client
+        if rebuild:
+            self._user_list = yield from hangups.user.build_user_list(self._client,
+                                                                      initial_data)
 
-        self._conv_list = hangups.ConversationList(self._client,
-                                                   initial_data.conversation_states,
-                                                   self._user_list,
-                                                   initial_data.sync_timestamp)
+            self._conv_list = hangups.ConversationList(self._client,
+                                                       initial_data.conversation_states,
+                                                       self._user_list,
+                                                       initial_data.sync_timestamp)
+            self._lists_client = self._client
+        else:
+            # same client reconnected, its events kept both lists current
+            logger.info("reconnected, keeping user and conversation lists")
 
         self.conversations = yield from permamem.initialise_permanent_memory(self)
 
@@ -532,12 +565,14 @@ class HangupsBot(object):
         plugins.load(self, "commands.basic")
         plugins.load(self, "commands.tagging")
         plugins.load(self, "commands.permamem")
+        plugins.load(self, "commands.memory")
         plugins.load(self, "commands.convid")
         plugins.load(self, "commands.loggertochat")
         plugins.load_user_plugins(self)
 
-        self._conv_list.on_event.add_observer(self._on_event)
-        self._client.on_state_update.add_observer(self._on_status_changes)
+        if rebuild:
+            self._conv_list.on_event.add_observer(self._on_event)
+            self._client.on_state_update.add_observer(self._on_status_changes)
 
         logger.info("bot initialised")
 
@@ -577,8 +612,11 @@ class HangupsBot(object):
 
         event = ConversationEvent(self, conv_event)
 
-        yield from self.conversations.update(self._conv_list.get(conv_event.conversation_id), 
-                                             source="event")
+        # membership and rename events always refresh, other events only if the conversation changed
+        yield from self.conversations.update(self._conv_list.get(conv_event.conversation_id),
+                                             source="event",
+                                             force=isinstance(conv_event, (hangups.MembershipChangeEvent,
+                                                                           hangups.RenameEvent)))
 
         if isinstance(conv_event, hangups.ChatMessageEvent):
             self._execute_hook("on_chat_message", event)
@@ -0,0 +1,228 @@
+"""retention policies for memory subtrees that otherwise only ever grow
+
+rules are configured with the "memory-retention" config option, a subtree set to false is
+left alone, missing settings use the defaults below:
+    "memory-retention": {
+        "interval": 86400,
+        "user_data": { "max_age_days": 730, "prunable_keys": ["_hangups", "1on1"] },
+        "convmem": { "max_age_days": 365 },
+        "invites": { "grace_days": 7 },
+        "tldr": { "max_entries": 100, "max_age_days": 0 } }
+
+interval (seconds, at least MINIMUM_INTERVAL) enables the scheduled background run, rules are
+always available to admins through the memoryretention command
+"""
+import collections, datetime, json, logging, time
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RULES = {
+    "user_data": { "max_age_days": 730, "prunable_keys": ["_hangups", "1on1"] },
+    "convmem": { "max_age_days": 365 },
+    "invites": { "grace_days": 7 },
+    "tldr": { "max_entries": 100, "max_age_days": 0 } }
+
+MINIMUM_INTERVAL = 3600
+
+
+def get_rules(bot):
+    """merge configured rules over the defaults, returns (rules, interval)"""
+    configured = bot.get_config_option("memory-retention") or {}
+
+    rules = {}
+    for subtree, defaults in DEFAULT_RULES.items():
+        rule = configured.get(subtree, {})
+        if rule is False:
+            continue
+        rules[subtree] = dict(defaults)
+        if isinstance(rule, dict):
+            rules[subtree].update(rule)
+
+    return rules, int(configured.get("interval") or 0)
+
+
+def _updated_before(record, cutoff):
+    """records written by permamem carry an "updated" %Y%m%d%H%M%S timestamp"""
+    updated = record.get("updated") if isinstance(record, collections.MutableMapping) else None
+    if not updated:
+        return False
+    return updated < cutoff
+
+
+def _cutoff(days):
+    return (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y%m%d%H%M%S")
+
+
+def _participants(bot):
+    participants = set()
+    for conv in bot.memory.get_or_default(("convmem",), {}).values():
+        participants.update(conv.get("participants", []))
+    return participants
+
+
+def prune_user_data(bot, rule):
+    """users that are in no known conversation and have not changed in max_age_days,
+    records holding anything other than cached hangups data are kept"""
+    user_data = bot.memory.get_or_default(("user_data",))
+    if not user_data:
+        return []
+
+    cutoff = _cutoff(rule["max_age_days"])
+    prunable_keys = set(rule["prunable_keys"])
+    keep = _participants(bot) | set(bot.get_config_option("admins") or [])
+
+    paths = []
+    for chat_id, record in user_data.items():
+        if chat_id in keep or not isinstance(record, dict):
+            continue
+        _hangups = record.get("_hangups")
+        if not _hangups or _hangups.get("is_self"):
+            continue
+        if set(record) - prunable_keys:
+            continue
+        if _updated_before(_hangups, cutoff):
+            paths.append(("user_data", chat_id))
+
+    return paths
+
+
+def _is_current(bot, conv_id):
+    """True if the bot is still part of the conversation, archived ones included"""
+    try:
+        bot._conv_list.get(conv_id)
+    except KeyError:
+        return False
+    return True
+
+
+def prune_convmem(bot, rule):
+    """group conversations the bot is no longer part of, unchanged for max_age_days
+    their conv_data and tldr entries go with them"""
+    convmem = bot.memory.get_or_default(("convmem",))
+    if not convmem:
+        return []
+
+    cutoff = _cutoff(rule["max_age_days"])
+
+    paths = []
+    for conv_id, conv in convmem.items():
+        if conv.get("type") != "GROUP" or _is_current(bot, conv_id):
+            continue
+        if _updated_before(conv, cutoff):
+            paths.append(("convmem", conv_id))
+            for subtree in ("conv_data", "tldr"):
+                if bot.memory.get_or_default((subtree, conv_id)) is not None:
+                    paths.append((subtree, conv_id))
+
+    return paths
+
+
+def prune_invites(bot, rule):
+    """invitations that expired more than grace_days ago"""
+    invites = bot.memory.get_or_default(("invites",))
+    if not invites:
+        return []
+
+    cutoff = time.time() - rule["grace_days"] * 86400
+
+    return [ ("invites", invite_id) for invite_id, invite in invites.items()
+             if invite.get("expiry", cutoff) < cutoff ]
+
+
+def prune_tldr(bot, rule):
+    """oldest entries beyond max_entries per conversation, and entries older than max_age_days"""
+    tldr = bot.memory.get_or_default(("tldr",))
+    if not tldr:
+        return []
+
+    cutoff = time.time() - rule["max_age_days"] * 86400 if rule["max_age_days"] else 0
+
+    paths = []
+    for conv_id, conv_tldr in tldr.items():
+        timestamps = sorted(conv_tldr, key=float, reverse=True)
+        for index, timestamp in enumerate(timestamps):
+            if (rule["max_entries"] and index >= rule["max_entries"]) or float(timestamp) < cutoff:
+                paths.append(("tldr", conv_id, timestamp))
+
+    return paths
+
+
+RULES = {
+    "user_data": prune_user_data,
+    "convmem": prune_convmem,
+    "invites": prune_invites,
+    "tldr": prune_tldr }
+
+
+def _serialise(subtree):
+    """time and size of writing a subtree, as a save would"""
+    start_time = time.time()
+    text = json.dumps(dict(subtree.items()), indent=2, sort_keys=True, default=config.json_default)
+    return len(text.encode("utf-8")), time.time() - start_time
+
+
+def _without(subtree, paths):
+    """shallow copy of subtree with paths (relative to it) left out, for dry runs"""
+    pruned = dict(subtree.items())
+    for path in paths:
+        parent = pruned
+        for key in path[:-1]:
+            parent[key] = parent = dict(parent[key])
+        parent.pop(path[-1], None)
+    return pruned
+
+
+def run(bot, apply=False, rules=None):
+    """evaluate retention rules, remove the matching entries if apply=True
+    returns { top-level key: { "removed", "bytes_before", "bytes_after", "save_before", "save_after" } }"""
+    if rules is None:
+        rules, _interval = get_rules(bot)
+
+    candidates = []
+    for subtree, rule in sorted(rules.items()):
+        candidates.extend(RULES[subtree](bot, rule))
+
+    # drop paths inside a subtree that is removed entirely (tldr of a pruned conversation)
+    removed = set(candidates)
+    paths = [ path for path in candidates
+              if not any(path[:depth] in removed for depth in range(1, len(path))) ]
+
+    by_key = {}
+    for path in paths:
+        by_key.setdefault(path[0], []).append(path)
+
+    report = {}
+    for key, key_paths in sorted(by_key.items()):
+        bytes_before, save_before = _serialise(bot.memory[key])
+        report[key] = { "removed": len(key_paths),
+                        "bytes_before": bytes_before,
+                        "save_before": save_before }
+        if not apply:
+            report[key]["bytes_after"], report[key]["save_after"] = _serialise(
+                _without(bot.memory[key], [ path[1:] for path in key_paths ]))
+
+    if apply and paths:
+        for path in paths:
+            if path[0] == "user_data" and len(path) == 2:
+                bot.conversations.remove_1on1(path[1])
+            bot.memory.pop_by_path(list(path))
+            if path[0] == "convmem":
+                bot.conversations.catalog_remove(path[1])
+
+        if any(path[0] in ("user_data", "conv_data") for path in paths):
+            # removed records may have carried user, conversation or per-conversation user tags
+            bot.tags.refresh_indices()
+
+        for key in report:
+            report[key]["bytes_after"], report[key]["save_after"] = _serialise(bot.memory[key])
+
+        bot.memory.save()
+
+        logger.info("removed {} entries: {}".format(
+            len(paths), { key: value["removed"] for key, value in report.items() }))
+
+    return report
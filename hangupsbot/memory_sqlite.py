@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""sqlite storage backend for bot memory
+
+user_data, conv_data and convmem records are stored as rows in a local sqlite database,
+loaded lazily on first access. a record changed with set_by_path()/pop_by_path() is written
+in its own transaction right away, other changes in a single transaction per save.
+all writes happen on the writer thread. all other memory keys remain in memory.json and
+are handled by config.Config
+
+the few fields that startup passes over all records need (1-to-1 conversations, tags,
+cached users) are kept in a separate summary column, see Config.record_fields()
+
+import/export between the json format and the database:
+    python3 memory_sqlite.py import memory.json [memory.sqlite]
+    python3 memory_sqlite.py export memory.json [memory.sqlite]
+"""
+import argparse, collections, hashlib, json, logging, os, shutil, sqlite3, sys, threading, time
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+GROUPINGS = ("user_data", "conv_data", "convmem")
+
+"""record fields stored in the summary column, in this order"""
+SUMMARY_PATHS = ( ("1on1",),
+                  ("tags",),
+                  ("tags-users",),
+                  ("_hangups", "is_definitive") )
+
+
+def default_database(filename):
+    return os.path.splitext(filename)[0] + ".sqlite"
+
+
+def connect(database):
+    connection = sqlite3.connect(database, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS records ("
+                       " grouping TEXT NOT NULL,"
+                       " id TEXT NOT NULL,"
+                       " data TEXT NOT NULL,"
+                       " summary TEXT,"
+                       " PRIMARY KEY (grouping, id)) WITHOUT ROWID")
+
+    columns = [ row[1] for row in connection.execute("PRAGMA table_info(records)") ]
+    if "summary" not in columns:
+        connection.execute("ALTER TABLE records ADD COLUMN summary TEXT")
+
+    missing = connection.execute("SELECT grouping, id, data FROM records WHERE summary IS NULL").fetchall()
+    if missing:
+        # database written before the summary column existed, a one-time pass
+        logger.info("{}: adding summaries to {} records".format(database, len(missing)))
+        connection.executemany("UPDATE records SET summary = ? WHERE grouping = ? AND id = ?",
+                               [ (_summary(json.loads(data)), grouping, id) for grouping, id, data in missing ])
+
+    connection.commit()
+    return connection
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True, default=config.json_default)
+
+
+def _summary(value):
+    return _dumps([ config._field(value, path) for path in SUMMARY_PATHS ])
+
+
+def _digest(data):
+    return hashlib.sha256(data.encode("utf-8")).digest()
+
+
+class RecordMap(collections.MutableMapping):
+    """dict-like view over the rows of one grouping, records are materialised on access"""
+    def __init__(self, connection, lock, grouping):
+        self._connection = connection
+        self._lock = lock
+        self.grouping = grouping
+
+        self._cache = {}
+        self._stored = {} # id: sha256 of the stored serialisation, maintained by the writer thread
+        self._dirty = set()
+        self._deleted = set()
+
+        with self._lock:
+            self._ids = { row[0] for row in self._connection.execute(
+                "SELECT id FROM records WHERE grouping = ?", (grouping,)) }
+
+    def _fetch(self, ids):
+        ids = [ id for id in ids if id not in self._cache ]
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                rows = self._connection.execute(
+                    "SELECT id, data FROM records WHERE grouping = ? AND id IN ({})".format(
+                        ",".join("?" * len(chunk))),
+                    [self.grouping] + chunk)
+                for id, data in rows:
+                    self._cache[id] = json.loads(data)
+                    self._stored[id] = _digest(data)
+
+    def prefetch(self):
+        """load every record in as few queries as possible, used before full scans"""
+        if len(self._cache) < len(self._ids):
+            self._fetch(list(self._ids))
+
+    def __getitem__(self, id):
+        try:
+            return self._cache[id]
+        except KeyError:
+            if id not in self._ids:
+                raise
+        self._fetch([id])
+        return self._cache[id]
+
+    def __setitem__(self, id, value):
+        self._cache[id] = value
+        self._ids.add(id)
+        self._dirty.add(id)
+        self._deleted.discard(id)
+
+    def __delitem__(self, id):
+        if id not in self._ids:
+            raise KeyError(id)
+        self._ids.remove(id)
+        self._cache.pop(id, None)
+        self._dirty.discard(id)
+        self._deleted.add(id)
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def get(self, id, default=None):
+        if id in self._ids:
+            return self[id]
+        return default
+
+    def __iter__(self):
+        return iter(list(self._ids))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def items(self):
+        self.prefetch()
+        return [ (id, self._cache[id]) for id in list(self._ids) ]
+
+    def values(self):
+        self.prefetch()
+        return [ self._cache[id] for id in list(self._ids) ]
+
+    def replace(self, records):
+        for id in list(self._ids):
+            del self[id]
+        for id, value in records.items():
+            self[id] = value
+
+    def changes(self, everything=False):
+        """pending changes as ([ (id, serialised record) ], [ id ]): dirty records (all materialised
+        records if everything=True, for in-place modifications signalled by force_taint) and deleted ids
+        records are serialised here, on the event loop, the writer thread never sees live records"""
+        ids = list(self._cache) if everything else list(self._dirty & self._ids)
+        upserts = [ (id, _dumps(self._cache[id])) for id in ids ]
+        deletes = list(self._deleted)
+
+        self._dirty = set()
+        self._deleted = set()
+
+        return upserts, deletes
+
+    def take(self, id):
+        """pending change of a single record, in the format of changes()"""
+        self._dirty.discard(id)
+        if id in self._ids:
+            return [ (id, _dumps(self[id])) ], []
+        if id in self._deleted:
+            self._deleted.discard(id)
+            return [], [ id ]
+        return [], []
+
+    def fields(self, paths):
+        """Config.record_fields() for SUMMARY_PATHS, materialised records are read from memory,
+        all others from the summary column"""
+        positions = [ SUMMARY_PATHS.index(tuple(path)) for path in paths ]
+
+        result = [ (id, [ config._field(record, path) for path in paths ])
+                   for id, record in self._cache.items() ]
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, summary FROM records WHERE grouping = ?", (self.grouping,)).fetchall()
+        for id, summary in rows:
+            if id in self._cache or id not in self._ids:
+                continue
+            summary = json.loads(summary)
+            result.append((id, [ summary[position] for position in positions ]))
+
+        return result
+
+    def rows(self, upserts, deletes):
+        """runs on the writer thread: leave out serialised records identical to the stored row,
+        returns the statement parameters for upserts and deletes"""
+        upsert_rows = []
+        for id, data in upserts:
+            digest = _digest(data)
+            if self._stored.get(id) != digest:
+                upsert_rows.append((self.grouping, id, data, _summary(json.loads(data))))
+                self._stored[id] = digest
+
+        for id in deletes:
+            self._stored.pop(id, None)
+
+        return upsert_rows, [ (self.grouping, id) for id in deletes ]
+
+
+class SQLiteConfig(config.Config):
+    """memory storage with record groupings in sqlite, everything else in json"""
+    def __init__(self, filename, database=None, groupings=GROUPINGS, **kwargs):
+        self.database = database or default_database(filename)
+        self.groupings = tuple(groupings)
+
+        self._lock = threading.RLock()
+        self._connection = connect(self.database)
+        self._records = {}
+        self._records_force = False
+
+        logger.info("sqlite backend: {} {}".format(self.database, self.groupings))
+
+        super().__init__(filename, **kwargs)
+
+    def _after_load(self):
+        self._records = {}
+        for grouping in self.groupings:
+            legacy = self.config.pop(grouping, None)
+
+            records = RecordMap(self._connection, self._lock, grouping)
+            self._records[grouping] = records
+            self.config[grouping] = records
+
+            if isinstance(legacy, dict):
+                # memory.json still has the grouping, migrate it into the database
+                if len(records) > 0:
+                    logger.warning("{}: {} in json ignored, database already has {} records".format(
+                        self.filename, grouping, len(records)))
+                else:
+                    logger.info("{}: migrating {} {} records".format(self.filename, len(legacy), grouping))
+                    records.replace(legacy)
+                self._taint(grouping)
+                self._journal_snapshot_required = True
+
+    def _persisted_keys(self):
+        return set(self.config) - set(self._records)
+
+    def checksum(self):
+        """records are not covered by file checksums"""
+        return None
+
+    def _journal_append(self, keys_list):
+        if keys_list[0] in self._records:
+            # records are already written transactionally
+            return
+        super()._journal_append(keys_list)
+
+    def record_fields(self, key, paths):
+        """summary fields are answered from their column, without loading the records"""
+        if key in self._records and all(tuple(path) in SUMMARY_PATHS for path in paths):
+            return self._records[key].fields(paths)
+        return super().record_fields(key, paths)
+
+    def _records_submit(self, changes):
+        """write [ (RecordMap, upserts, deletes) ] in one transaction on the writer thread"""
+        changes = [ change for change in changes if change[1] or change[2] ]
+        if changes:
+            self._writer_submit(self._records_write, changes)
+
+    def _records_write(self, changes):
+        """runs on the writer thread"""
+        start_time = time.time()
+
+        upserts = []
+        deletes = []
+        for records, _upserts, _deletes in changes:
+            _upsert_rows, _delete_rows = records.rows(_upserts, _deletes)
+            upserts.extend(_upsert_rows)
+            deletes.extend(_delete_rows)
+
+        if upserts or deletes:
+            serialise_time = time.time() - start_time
+
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO records (grouping, id, data, summary) VALUES (?, ?, ?, ?)", upserts)
+                self._connection.executemany(
+                    "DELETE FROM records WHERE grouping = ? AND id = ?", deletes)
+
+            self._metrics_record("sqlite", bytes=sum(len(row[2]) for row in upserts),
+                                 upserts=len(upserts), deletes=len(deletes),
+                                 serialise=serialise_time, total=time.time() - start_time)
+
+            logger.debug("{} commit {} {}".format(self.database, len(upserts), len(deletes)))
+
+    def _records_commit(self, key=None):
+        """write the pending changes of one grouping (all groupings if key is None)"""
+        groupings = self._records.values() if key is None else [ self._records[key] ]
+        self._records_submit([ (records,) + records.changes(everything=self._records_force)
+                               for records in groupings ])
+        if key is None:
+            self._records_force = False
+
+    def force_taint(self):
+        super().force_taint()
+        self._records_force = True
+
+    def save(self, delay=True):
+        if self.save_delay and delay:
+            return super().save(delay)
+
+        if self.changed:
+            # changes made in-place or directly on the record maps
+            self._records_commit()
+
+        return super().save(delay=False)
+
+    def _record_write(self, keys_list):
+        if keys_list[0] in self._records and len(keys_list) > 1:
+            records = self._records[keys_list[0]]
+            self._records_submit([ (records,) + records.take(keys_list[1]) ])
+
+    def set_by_path(self, keys_list, value):
+        if len(keys_list) == 1 and keys_list[0] in self._records:
+            self[keys_list[0]] = value
+            return
+        super().set_by_path(keys_list, value)
+        self._record_write(keys_list)
+
+    def pop_by_path(self, keys_list):
+        if len(keys_list) == 1 and keys_list[0] in self._records:
+            popped_value = dict(self._records[keys_list[0]].items())
+            del self[keys_list[0]]
+            return popped_value
+        popped_value = super().pop_by_path(keys_list)
+        self._record_write(keys_list)
+        return popped_value
+
+    def __setitem__(self, key, value):
+        if key in self._records:
+            self._records[key].replace(value)
+            self._taint(key)
+            self._records_commit(key)
+        else:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key in self._records:
+            self._records[key].replace({})
+            self._taint(key)
+            self._records_commit(key)
+        else:
+            super().__delitem__(key)
+
+
+def import_json(filename, database, groupings=GROUPINGS):
+    """move record groupings from a json memory file into the database"""
+    memory = json.load(open(filename))
+
+    connection = connect(database)
+    with connection:
+        for grouping in groupings:
+            records = memory.pop(grouping, {})
+            connection.execute("DELETE FROM records WHERE grouping = ?", (grouping,))
+            connection.executemany(
+                "INSERT INTO records (grouping, id, data, summary) VALUES (?, ?, ?, ?)",
+                [ (grouping, id, _dumps(value), _summary(value)) for id, value in records.items() ])
+            logger.info("imported {} {}".format(len(records), grouping))
+    connection.close()
+
+    # outside the <filename>.*.bak pattern of failsafe backups, rotating those must never remove it
+    shutil.copy2(filename, filename + ".pre-sqlite")
+    with open(filename, 'w') as f:
+        json.dump(memory, f, indent=2, sort_keys=True)
+
+
+def export_json(filename, database, groupings=GROUPINGS):
+    """merge record groupings from the database back into a json memory file"""
+    try:
+        memory = json.load(open(filename))
+    except IOError:
+        memory = {}
+
+    connection = connect(database)
+    for grouping in groupings:
+        memory[grouping] = { id: json.loads(data) for id, data in connection.execute(
+            "SELECT id, data FROM records WHERE grouping = ?", (grouping,)) }
+        logger.info("exported {} {}".format(len(memory[grouping]), grouping))
+    connection.close()
+
+    with open(filename, 'w') as f:
+        json.dump(memory, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='memory_sqlite',
+                                     description='convert bot memory between json and sqlite storage')
+    parser.add_argument('action', choices=['import', 'export'],
+                        help='import: json -> sqlite, export: sqlite -> json')
+    parser.add_argument('memory', help='memory.json path')
+    parser.add_argument('database', nargs='?', help='database path, default: memory path with .sqlite extension')
+    parser.add_argument('-d', '--debug', action='store_true', help='log detailed debugging messages')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    database = args.database or default_database(args.memory)
+
+    if args.action == 'import':
+        import_json(args.memory, database)
+    else:
+        export_json(args.memory, database)
+
+
+if __name__ == '__main__':
+    main()
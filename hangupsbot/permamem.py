@@ -1,4 +1,4 @@
-import asyncio, datetime, logging, random, re
+import asyncio, bisect, collections, datetime, functools, logging, os, pickle, random, re, sys, time
 
 import hangups
 
@@ -28,12 +28,67 @@ def name_from_hangups_conversation(conv):
             return ', '.join(names)
 
 
+@functools.lru_cache(maxsize=256)
+def compile_filter(filter):
+    """parse a get() filter into a tuple of clauses (joined by and) of terms (joined by or)
+    sequential evaluation of "(a) or (b) and (c) or (d)" narrows the matches at every "and",
+    so it is equivalent to (a or b) and (c or d)"""
+    clauses = []
+    terms = []
+    raw_filter = filter.strip()
+    while raw_filter.startswith("("):
+        tokens = re.split(r"(?<!\\)(?:\\\\)*\)", raw_filter, maxsplit=1)
+        terms.append(tokens[0][1:])
+        if len(tokens) == 2:
+            raw_filter = tokens[1]
+            if not raw_filter:
+                # finished consuming entire string
+                pass
+            elif re.match(r"^\s*and\s*\(", raw_filter, re.IGNORECASE):
+                clauses.append(tuple(terms))
+                terms = []
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            elif re.match(r"^\s*or\s*\(", raw_filter, re.IGNORECASE):
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            else:
+                raise ValueError("invalid boolean operator near \"{}\"".format(raw_filter.strip()))
+        else:
+            # unterminated term, consumed entirely
+            raw_filter = ""
+
+    if raw_filter or len(terms)==0:
+        # second condition is to ensure at least one term, even if blank
+        terms.append(raw_filter)
+
+    clauses.append(tuple(terms))
+
+    return tuple(clauses)
+
+
 @asyncio.coroutine
 def initialise_permanent_memory(bot):
-    permamem = conversation_memory(bot)
+    """on reconnect the existing catalog, indexes and fingerprints are kept, on startup they are
+    restored from the warm start snapshot if memory is unchanged since it was written
+    either way only conversations that differ from the server state get a full update(),
+    and the hangups user list is completed from the participants in memory"""
+    permamem = getattr(bot, "conversations", None)
+    reconnect = isinstance(permamem, conversation_memory)
+    if not reconnect:
+        permamem = conversation_memory(bot)
+
+    refresh_interval = bot.get_config_option("permamem-refresh_interval")
+    if refresh_interval is not None:
+        permamem.refresh_interval = refresh_interval
+
+    if reconnect or permamem.load_warm_start():
+        if reconnect:
+            logger.info("reconnected, keeping {} conversations".format(len(permamem.catalog)))
+        # the catalog is kept or restored, the hangups user list may be new
+        yield from permamem.load_users_from_memory()
+    else:
+        yield from permamem.standardise_memory()
+        yield from permamem.load_from_memory()
 
-    yield from permamem.standardise_memory()
-    yield from permamem.load_from_memory()
     yield from permamem.load_from_hangups()
 
     permamem.stats()
@@ -43,16 +98,357 @@ def initialise_permanent_memory(bot):
     return permamem
 
 
+class _record(collections.MutableMapping):
+    """compact stand-in for a json object with a known set of keys
+    expected keys live in __slots__ (an unset slot is an absent key), anything else goes
+    to _extra, so plugins can keep treating records as dicts. ids are interned, and they
+    serialise through config.json_default"""
+    __slots__ = ("_extra",)
+
+    _fields = ()
+    _interned = frozenset()
+
+    def __init__(self, data=()):
+        self._extra = None
+        for key, value in (data.items() if hasattr(data, "items") else data):
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            if key in self._interned and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for key in self.__slots__ if hasattr(self, key)) + len(self._extra or ())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class conversation_record(_record):
+    """memory["convmem"][conv_id], also the catalog entry"""
+    __slots__ = ("title", "type", "history", "participants", "source", "updated")
+
+    _fields = frozenset(__slots__)
+    _interned = frozenset(["type", "source"])
+
+    def __setitem__(self, key, value):
+        if key == "participants" and type(value) is list:
+            value[:] = [ sys.intern(chat_id) if type(chat_id) is str else chat_id for chat_id in value ]
+        super().__setitem__(key, value)
+
+
+class user_record(_record):
+    """memory["user_data"][chat_id]["_hangups"]"""
+    __slots__ = ("chat_id", "gaia_id", "full_name", "first_name", "photo_url", "emails",
+                 "is_self", "is_definitive", "updated")
+
+    _fields = frozenset(__slots__)
+    _interned = frozenset(["chat_id", "gaia_id"])
+
+
+def compact_records(convmem, user_data):
+    """convert plain dict convmem entries and user_data.*._hangups to records, in place"""
+    if isinstance(convmem, dict):
+        for conv_id, conv in convmem.items():
+            if type(conv) is dict:
+                convmem[conv_id] = conversation_record(conv)
+
+    if isinstance(user_data, dict):
+        for user in user_data.values():
+            if type(user) is dict and type(user.get("_hangups")) is dict:
+                user["_hangups"] = user_record(user["_hangups"])
+
+
+class entity_lookup:
+    """shared getentitybyid() service
+    concurrent requests for the same chat_id share one in-flight future, ids requested within
+    batch_window seconds are batched together, at most concurrency chunks run at once and
+    ids the server could not resolve are not asked for again for negative_ttl seconds"""
+
+    batch_window = 0.05
+    batch_max = 20
+    concurrency = 3
+    negative_ttl = 3600
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._in_flight = {} # chat_id: future resolving to a hangups User or None
+        self._queue = []
+        self._timer = None
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._unresolvable = {} # chat_id: time the negative entry expires
+
+    @asyncio.coroutine
+    def lookup(self, chat_ids):
+        """returns { chat_id: hangups User } for the chat_ids the server resolved"""
+        now = time.time()
+
+        futures = {}
+        for chat_id in set(chat_ids):
+            if self._unresolvable.get(chat_id, 0) > now:
+                continue
+            future = self._in_flight.get(chat_id)
+            if future is None:
+                future = asyncio.Future()
+                self._in_flight[chat_id] = future
+                self._queue.append(chat_id)
+            futures[chat_id] = future
+
+        if self._queue and self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.batch_window, self._dispatch)
+
+        if not futures:
+            return {}
+
+        yield from asyncio.wait(list(futures.values()))
+
+        return { chat_id: future.result() for chat_id, future in futures.items()
+                 if future.result() is not None }
+
+    def _dispatch(self):
+        self._timer = None
+        queue, self._queue = self._queue, []
+        for i in range(0, len(queue), self.batch_max):
+            asyncio.async(self._fetch(queue[i:i+self.batch_max]))
+
+    @asyncio.coroutine
+    def _fetch(self, chunk):
+        resolved = {}
+        failed = False
+
+        with (yield from self._semaphore):
+            logger.debug("getentitybyid(): {}".format(chunk))
+            try:
+                response = yield from self.bot._client.getentitybyid(chunk)
+
+                for _user in response.entities:
+                    UserID = hangups.user.UserID(chat_id=_user.id_.chat_id, gaia_id=_user.id_.gaia_id)
+                    resolved[_user.id_.chat_id] = hangups.user.User(
+                        UserID,
+                        _user.properties.display_name,
+                        _user.properties.first_name,
+                        _user.properties.photo_url,
+                        _user.properties.emails,
+                        False)
+
+            except hangups.exceptions.NetworkError as e:
+                # transient, nothing is cached
+                logger.exception("getentitybyid(): FAILED for chunk {}".format(chunk))
+                failed = True
+
+            except Exception as e:
+                logger.exception("getentitybyid(): unexpected error for chunk {}".format(chunk))
+                failed = True
+
+        expiry = time.time() + self.negative_ttl
+        for chat_id in chunk:
+            if chat_id not in resolved and not failed:
+                self._unresolvable[chat_id] = expiry
+            future = self._in_flight.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result(resolved.get(chat_id))
+
+        if self._unresolvable and len(self._unresolvable) > 1000:
+            now = time.time()
+            self._unresolvable = { chat_id: until for chat_id, until in self._unresolvable.items() if until > now }
+
+
 class conversation_memory:
     bot = None
     catalog = {}
 
+    """state written to <memory file>.warmstart at clean shutdown, the catalog itself is
+    memory["convmem"] and is not duplicated"""
+    WARM_START_VERSION = 1
+    WARM_START_ATTRIBUTES = ( "_fingerprints",
+                              "_1on1_by_user", "_1on1_by_conv",
+                              "_index_participant", "_index_type", "_index_count",
+                              "_index_trigram", "_titles_lower" )
+
     log_info_unchanged = False
 
+    refresh_interval = 3600 # seconds before an unchanged conversation gets a full update()
+
     def __init__(self, bot):
         self.bot = bot
         self.catalog = {}
 
+        """conv_id: (fingerprint, time of last full update), lets update() skip unchanged conversations"""
+        self._fingerprints = {}
+
+        self.entity_lookup = entity_lookup(bot)
+
+        """bidirectional 1-to-1 index, mirrors memory["user_data"][chat_id]["1on1"]"""
+        self._1on1_by_user = {} # chat_id: conv_id
+        self._1on1_by_conv = {} # conv_id: chat_id
+
+        """secondary indexes for get() filters, maintained by catalog_set() and catalog_remove()"""
+        self._index_participant = {} # chat_id: set of conv_ids
+        self._index_type = {} # lowercase type: set of conv_ids
+        self._index_count = [] # sorted (participant count, conv_id)
+        self._index_trigram = {} # title trigram: set of conv_ids
+        self._titles_lower = {} # conv_id: lowercase title
+
+    @staticmethod
+    def _trigrams(text):
+        return { text[i:i+3] for i in range(len(text) - 2) }
+
+    def _index_add(self, conv_id, convdata):
+        for chat_id in convdata.get("participants", []):
+            self._index_participant.setdefault(chat_id, set()).add(conv_id)
+
+        self._index_type.setdefault(convdata.get("type", "unknown").lower(), set()).add(conv_id)
+
+        bisect.insort(self._index_count, (len(convdata.get("participants", [])), conv_id))
+
+        title = convdata.get("title", "").lower()
+        self._titles_lower[conv_id] = title
+        for trigram in self._trigrams(title):
+            self._index_trigram.setdefault(trigram, set()).add(conv_id)
+
+    def _index_discard(self, conv_id, convdata):
+        for chat_id in convdata.get("participants", []):
+            self._discard_from(self._index_participant, chat_id, conv_id)
+
+        self._discard_from(self._index_type, convdata.get("type", "unknown").lower(), conv_id)
+
+        entry = (len(convdata.get("participants", [])), conv_id)
+        position = bisect.bisect_left(self._index_count, entry)
+        if position < len(self._index_count) and self._index_count[position] == entry:
+            del self._index_count[position]
+
+        for trigram in self._trigrams(self._titles_lower.pop(conv_id, "")):
+            self._discard_from(self._index_trigram, trigram, conv_id)
+
+    @staticmethod
+    def _discard_from(index, key, conv_id):
+        conv_ids = index.get(key)
+        if conv_ids is not None:
+            conv_ids.discard(conv_id)
+            if not conv_ids:
+                del index[key]
+
+    def _build_1on1_index(self):
+        self._1on1_by_user = {}
+        self._1on1_by_conv = {}
+        for chat_id, [conv_id] in self.bot.memory.record_fields("user_data", [("1on1",)]):
+            if conv_id:
+                self._1on1_by_user[chat_id] = conv_id
+                self._1on1_by_conv[conv_id] = chat_id
+
+    def get_1on1_id(self, chat_id):
+        """remembered 1-to-1 conversation id with a user, or None"""
+        return self._1on1_by_user.get(chat_id)
+
+    def get_1on1_user(self, conv_id):
+        """chat_id of the user a remembered 1-to-1 conversation is with, or None"""
+        return self._1on1_by_conv.get(conv_id)
+
+    def set_1on1(self, chat_id, conv_id):
+        """remember a 1-to-1 conversation, all writes to user_data.<chat_id>.1on1 must go through here
+
+        an empty conv_id forgets the conversation, see remove_1on1()"""
+        if not conv_id:
+            self.remove_1on1(chat_id)
+            return
+
+        self.bot.initialise_memory(chat_id, "user_data")
+        self.bot.memory.set_by_path(["user_data", chat_id, "1on1"], conv_id)
+
+        previous = self._1on1_by_user.get(chat_id)
+        if previous is not None and self._1on1_by_conv.get(previous) == chat_id:
+            del self._1on1_by_conv[previous]
+        self._1on1_by_user[chat_id] = conv_id
+        self._1on1_by_conv[conv_id] = chat_id
+
+    def remove_1on1(self, chat_id):
+        conv_id = self._1on1_by_user.pop(chat_id, None)
+        if conv_id is not None and self._1on1_by_conv.get(conv_id) == chat_id:
+            del self._1on1_by_conv[conv_id]
+        if self.bot.memory.exists(("user_data", chat_id, "1on1")):
+            self.bot.memory.pop_by_path(["user_data", chat_id, "1on1"])
+
+    def search_1on1(self, chat_id):
+        """id of a known conversation between the bot and only this user, or None"""
+        for conv_id in self._index_participant.get(chat_id, ()):
+            if self.catalog[conv_id]["participants"] == [chat_id]:
+                return conv_id
+        return None
+
+    def catalog_set(self, conv_id, convdata):
+        """add or replace a catalog entry, all catalog writes must go through here or catalog_remove()"""
+        previous = self.catalog.get(conv_id)
+        if previous is not None:
+            self._index_discard(conv_id, previous)
+        self.catalog[conv_id] = convdata
+        self._index_add(conv_id, convdata)
+
+        if previous is None or previous.get("type") != convdata.get("type"):
+            self._invalidate_tags(conv_id)
+
+    def catalog_remove(self, conv_id):
+        self._fingerprints.pop(conv_id, None)
+        convdata = self.catalog.pop(conv_id, None)
+        if convdata is not None:
+            self._index_discard(conv_id, convdata)
+            self._invalidate_tags(conv_id)
+        return convdata
+
+    def _invalidate_tags(self, conv_id):
+        """resolved user tags depend on whether a conversation exists and on its type"""
+        tags = getattr(self.bot, "tags", None)
+        if tags is not None:
+            tags.invalidate(conv_id=conv_id)
+
     def stats(self):
         logger.info("total conversations: {}".format(len(self.catalog)))
 
@@ -60,17 +456,88 @@ class conversation_memory:
             count_user = 0
             count_user_cached = 0
             count_user_cached_definitive = 0
-            for chat_id in self.bot.memory["user_data"]:
+            # is_definitive is always set on cached users
+            for chat_id, [is_definitive] in self.bot.memory.record_fields("user_data", [("_hangups", "is_definitive")]):
                 count_user = count_user + 1
-                if "_hangups" in self.bot.memory["user_data"][chat_id]:
+                if is_definitive is not None:
                     count_user_cached = count_user_cached + 1
-                    if self.bot.memory["user_data"][chat_id]["_hangups"]["is_definitive"]:
+                    if is_definitive:
                         count_user_cached_definitive = count_user_cached_definitive + 1
 
             logger.info("total users: {} cached: {} definitive (at start): {}".format(
                 count_user, count_user_cached, count_user_cached_definitive))
 
 
+    def _warm_start_filename(self):
+        if self.bot.get_config_option("permamem-warm_start") is False or self.bot.memory is None:
+            return None
+        return self.bot.memory.filename + ".warmstart"
+
+    def save_warm_start(self):
+        """snapshot the indexes and fingerprints, call after memory was flushed"""
+        filename = self._warm_start_filename()
+        if filename is None:
+            return False
+
+        checksum = self.bot.memory.checksum()
+        if checksum is None:
+            logger.info("warm start snapshot skipped, memory has no stable checksum")
+            return False
+
+        snapshot = { attribute: getattr(self, attribute) for attribute in self.WARM_START_ATTRIBUTES }
+        snapshot["version"] = self.WARM_START_VERSION
+        snapshot["checksum"] = checksum
+        snapshot["unresolvable"] = self.entity_lookup._unresolvable
+
+        try:
+            with open(filename + ".tmp", "wb") as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(filename + ".tmp", filename)
+        except (OSError, pickle.PicklingError) as e:
+            logger.exception("failed to write warm start snapshot {}".format(filename))
+            return False
+
+        logger.info("warm start snapshot written: {} conversations".format(len(self.catalog)))
+        return True
+
+    def load_warm_start(self):
+        """restore the snapshot written by save_warm_start() if memory is unchanged since
+        returns False if there is none or it is stale, the catalog then has to be rebuilt"""
+        filename = self._warm_start_filename()
+        if filename is None or not os.path.isfile(filename):
+            return False
+
+        try:
+            with open(filename, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.exception("failed to read warm start snapshot {}".format(filename))
+            return False
+
+        if snapshot.get("version") != self.WARM_START_VERSION:
+            logger.info("warm start snapshot ignored, version {}".format(snapshot.get("version")))
+            return False
+
+        checksum = self.bot.memory.checksum()
+        if checksum is None or snapshot.get("checksum") != checksum:
+            logger.info("warm start snapshot ignored, memory changed since it was written")
+            return False
+
+        convmem = self.bot.memory.get_or_default(("convmem",), {})
+        if set(convmem) != set(snapshot["_titles_lower"]):
+            logger.warning("warm start snapshot ignored, conversations do not match memory")
+            return False
+
+        self.compact_memory()
+
+        for attribute in self.WARM_START_ATTRIBUTES:
+            setattr(self, attribute, snapshot[attribute])
+        self.catalog = dict(convmem.items())
+        self.entity_lookup._unresolvable = snapshot["unresolvable"]
+
+        logger.info("warm start: {} conversations from {}".format(len(self.catalog), filename))
+        return True
+
     @asyncio.coroutine
     def standardise_memory(self):
         """construct the conversation memory keys and standardise the stored structure
@@ -78,6 +545,8 @@ class conversation_memory:
         """
         memory_updated = False
 
+        self._build_1on1_index()
+
         if not self.bot.memory.exists(['convmem']):
             self.bot.memory.set_by_path(['convmem'], {})
             memory_updated = True
@@ -109,22 +578,25 @@ class conversation_memory:
                 if len(conv["participants"]) > 1:
                     conv["type"] = "GROUP"
                     attribute_modified = True
-                else:
-                    if self.bot.memory.exists(["user_data"]):
-                        """inefficient one-off search"""
-                        for chat_id in self.bot.memory["user_data"]:
-                            if self.bot.memory.exists(["user_data", chat_id, "1on1"]):
-                                if self.bot.memory["user_data"][chat_id]["1on1"] == conv_id:
-                                    conv["type"] = "ONE_TO_ONE"
-                                    attribute_modified = True
-                                    break
+                elif self.get_1on1_user(conv_id) is not None:
+                    conv["type"] = "ONE_TO_ONE"
+                    attribute_modified = True
 
             if attribute_modified:
                 self.bot.memory.set_by_path(['convmem', conv_id], conv)
                 memory_updated = True
 
+        self.compact_memory()
+
         return memory_updated
 
+    def compact_memory(self):
+        """replace the plain dicts loaded for convmem entries and cached hangups users with
+        slotted records, in place and without tainting memory since their content is unchanged
+        backends that persist records individually (sqlite) keep their own objects"""
+        compact_records(self.bot.memory.get_or_default(("convmem",)),
+                        self.bot.memory.get_or_default(("user_data",)))
+
     @asyncio.coroutine
     def load_from_memory(self):
         """load "persisted" conversations from memory.json into self.catalog
@@ -135,55 +607,64 @@ class conversation_memory:
             convs = self.bot.memory.get_by_path(['convmem'])
             logger.info("loading {} conversations from memory".format(len(convs)))
 
-            _users_added = {}
-            _users_incomplete = {}
-            _users_unknown = {}
+            for convid in convs:
+                self.catalog_set(convid, convs[convid])
 
-            _users_to_fetch = []
+            yield from self.load_users_from_memory()
 
-            for convid in convs:
-                self.catalog[convid] = convs[convid]
 
-                if "participants" in self.catalog[convid] and len(self.catalog[convid]["participants"]) > 0:
-                    for _chat_id in self.catalog[convid]["participants"]:
-                        try:
-                            UserID = hangups.user.UserID(chat_id=_chat_id, gaia_id=_chat_id)
-                            User = self.bot._user_list._user_dict[UserID]
-                            results = self.store_user_memory(User, is_definitive=True, automatic_save=False)
-                            if results:
-                                _users_added[_chat_id] = User.full_name
+    @asyncio.coroutine
+    def load_users_from_memory(self):
+        """complete the hangups user list with the participants of catalogued conversations
+        also runs after a warm start, the snapshot does not cover the hangups user list
+        """
+
+        _users_added = {}
+        _users_incomplete = {}
+        _users_unknown = {}
 
-                        except KeyError:
-                            cached = False
-                            if self.bot.memory.exists(["user_data", _chat_id, "_hangups"]):
-                                cached = self.bot.memory.get_by_path(["user_data", _chat_id, "_hangups"])
-                                if cached["is_definitive"]:
-                                    if cached["full_name"].upper() == "UNKNOWN" and cached["full_name"] == cached["first_name"]:
-                                        # XXX: crappy way to detect hangups unknown users
-                                        logger.debug("user {} needs refresh".format(_chat_id))
-                                    else:
-                                        continue
+        _users_to_fetch = []
 
-                            if cached:
-                                _users_incomplete[_chat_id] = cached["full_name"]
-                            else:
-                                _users_unknown[_chat_id] = "unidentified"
+        for convid in self.catalog:
+            if "participants" in self.catalog[convid] and len(self.catalog[convid]["participants"]) > 0:
+                for _chat_id in self.catalog[convid]["participants"]:
+                    try:
+                        UserID = hangups.user.UserID(chat_id=_chat_id, gaia_id=_chat_id)
+                        User = self.bot._user_list._user_dict[UserID]
+                        results = self.store_user_memory(User, is_definitive=True, automatic_save=False)
+                        if results:
+                            _users_added[_chat_id] = User.full_name
 
-                            _users_to_fetch.append(_chat_id)
+                    except KeyError:
+                        cached = self.bot.memory.get_or_default(("user_data", _chat_id, "_hangups"), False)
+                        if cached:
+                            if cached["is_definitive"]:
+                                if cached["full_name"].upper() == "UNKNOWN" and cached["full_name"] == cached["first_name"]:
+                                    # XXX: crappy way to detect hangups unknown users
+                                    logger.debug("user {} needs refresh".format(_chat_id))
+                                else:
+                                    continue
 
-            if len(_users_added) > 0:
-                logger.info("added users: {}".format(_users_added))
+                        if cached:
+                            _users_incomplete[_chat_id] = cached["full_name"]
+                        else:
+                            _users_unknown[_chat_id] = "unidentified"
 
-            if len(_users_incomplete) > 0:
-                logger.info("incomplete users: {}".format(_users_incomplete))
+                        _users_to_fetch.append(_chat_id)
 
-            if len(_users_unknown) > 0:
-                logger.warning("unknown users: {}".format(_users_unknown))
+        if len(_users_added) > 0:
+            logger.info("added users: {}".format(_users_added))
 
-            """attempt to rebuilt the user data with hangups.client.getentitybyid()"""
+        if len(_users_incomplete) > 0:
+            logger.info("incomplete users: {}".format(_users_incomplete))
 
-            if len(_users_to_fetch) > 0:
-                yield from self.get_users_from_query(_users_to_fetch)
+        if len(_users_unknown) > 0:
+            logger.warning("unknown users: {}".format(_users_unknown))
+
+        """attempt to rebuilt the user data with hangups.client.getentitybyid()"""
+
+        if len(_users_to_fetch) > 0:
+            yield from self.get_users_from_query(_users_to_fetch)
 
 
     @asyncio.coroutine
@@ -202,40 +683,21 @@ class conversation_memory:
 
 
     @asyncio.coroutine
-    def get_users_from_query(self, chat_ids, batch_max=20):
-        """retrieve definitive user data by requesting it from the server"""
-
-        chat_ids = list(set(chat_ids))
+    def get_users_from_query(self, chat_ids, batch_max=None):
+        """retrieve definitive user data by requesting it from the server
+        requests go through the shared entity_lookup, batch_max is kept for compatibility"""
 
-        chunks = [chat_ids[i:i+batch_max] for i in range(0, len(chat_ids), batch_max)]
+        users = yield from self.entity_lookup.lookup(chat_ids)
 
         updated_users = 0
 
-        for chunk in chunks:
-            logger.debug("getentitybyid(): {}".format(chunk))
-
-            try:
-                response = yield from self.bot._client.getentitybyid(chunk)
-
-                for _user in response.entities:
-                    UserID = hangups.user.UserID(chat_id=_user.id_.chat_id, gaia_id=_user.id_.gaia_id)
-                    User = hangups.user.User(
-                        UserID,
-                        _user.properties.display_name,
-                        _user.properties.first_name,
-                        _user.properties.photo_url,
-                        _user.properties.emails,
-                        False)
-
-                    """this function usually called because hangups user list is incomplete, so help fill it in as well"""
-                    logger.debug("updating hangups user list {} ({})".format(User.id_.chat_id, User.full_name))
-                    self.bot._user_list._user_dict[User.id_] = User
+        for User in users.values():
+            """this function usually called because hangups user list is incomplete, so help fill it in as well"""
+            logger.debug("updating hangups user list {} ({})".format(User.id_.chat_id, User.full_name))
+            self.bot._user_list._user_dict[User.id_] = User
 
-                    if self.store_user_memory(User, is_definitive=True, automatic_save=False):
-                        updated_users = updated_users + 1
-
-            except hangups.exceptions.NetworkError as e:
-                logger.exception("getentitybyid(): FAILED for chunk {}".format(chunk))
+            if self.store_user_memory(User, is_definitive=True, automatic_save=False):
+                updated_users = updated_users + 1
 
         if updated_users > 0:
             self.bot.memory.save()
@@ -259,10 +721,9 @@ class conversation_memory:
             is_definitive = False
 
         """load existing cached user, reject update if cache is_definitive and supplied is not"""
-        cached = False
-        if self.bot.memory.exists(["user_data", User.id_.chat_id, "_hangups"]):
-            cached = self.bot.memory.get_by_path(["user_data", User.id_.chat_id, "_hangups"])
-            if "is_definitive" in cached and cached["is_definitive"] and is_definitive == False:
+        cached = self.bot.memory.get_or_default(("user_data", User.id_.chat_id, "_hangups"), False)
+        if cached:
+            if cached.get("is_definitive") and is_definitive == False:
                 if self.log_info_unchanged:
                     logger.info("skipped user update: {} ({})".format(cached["full_name"], cached["chat_id"]))
                 return False
@@ -317,7 +778,7 @@ class conversation_memory:
 
         if changed:
             user_dict["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            self.bot.memory.set_by_path(["user_data", User.id_.chat_id, "_hangups"], user_dict)
+            self.bot.memory.set_by_path(["user_data", User.id_.chat_id, "_hangups"], user_record(user_dict))
 
             if automatic_save:
                 self.bot.memory.save()
@@ -331,17 +792,29 @@ class conversation_memory:
         return changed
 
 
+    def _fingerprint(self, conv):
+        return ( frozenset(User.id_.chat_id for User in conv.users),
+                 conv.name,
+                 conv.is_off_the_record,
+                 conv._conversation.type_ )
+
     @asyncio.coroutine
-    def update(self, conv, source="unknown", automatic_save=True):
+    def update(self, conv, source="unknown", automatic_save=True, force=False):
         """update conversation memory based on supplied hangups Conversation
         conservative writing: on changed Conversation and/or User attribute changes
         return True on Conversation/User change, False on no changes
+        unless force=True, conversations with an unchanged fingerprint (participants, name, otr, type)
+        are skipped until refresh_interval has passed since their last full update
         """
+        fingerprint = self._fingerprint(conv)
+        if not force and conv.id_ in self.catalog:
+            cached = self._fingerprints.get(conv.id_)
+            if cached and cached[0] == fingerprint and time.time() - cached[1] < self.refresh_interval:
+                return False
+
         conv_title = name_from_hangups_conversation(conv)
 
-        original = {}
-        if self.bot.memory.exists(["convmem", conv.id_]):
-            original = self.bot.memory.get_by_path(["convmem", conv.id_])
+        original = self.bot.memory.get_or_default(("convmem", conv.id_)) or {}
 
         memory = {}
 
@@ -429,9 +902,10 @@ class conversation_memory:
 
         if conv_changed:
             memory["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            memory = conversation_record(memory)
             self.bot.memory.set_by_path(["convmem", conv.id_], memory)
 
-            self.catalog[conv.id_] = memory
+            self.catalog_set(conv.id_, memory)
 
             if automatic_save:
                 # if users_changed this would write those changes as well
@@ -450,6 +924,8 @@ class conversation_memory:
             elif self.log_info_unchanged:
                 logger.info("users from conv {} unchanged".format(conv.id_))
 
+        self._fingerprints[conv.id_] = (fingerprint, time.time())
+
         return conv_changed or users_changed
 
 
@@ -459,7 +935,7 @@ class conversation_memory:
             if _cached["type"] == "GROUP":
                 logger.info("removing conv: {} {}".format(conv_id, _cached["title"]))
                 self.bot.memory.pop_by_path(["convmem", conv_id])
-                del self.catalog[conv_id]
+                self.catalog_remove(conv_id)
 
             else:
                 logger.warning("cannot remove conv: {} {} {}".format(
@@ -474,109 +950,146 @@ class conversation_memory:
     def get(self, filter=""):
         """get dictionary of conversations that matches filter term(s) (ALL if not supplied)
         supports sequential boolean operations, each term must be enclosed with brackets ( ... )
+        the parsed filter is cached, clauses are evaluated most selective first
         """
 
-        terms = []
-        raw_filter = filter.strip()
-        operator = "start"
-        while raw_filter.startswith("("):
-            tokens = re.split(r"(?<!\\)(?:\\\\)*\)", raw_filter, maxsplit=1)
-            terms.append([operator, tokens[0][1:]])
-            if len(tokens) == 2:
-                raw_filter = tokens[1]
-                if not raw_filter:
-                    # finished consuming entire string
-                    pass
-                elif re.match(r"^\s*and\s*\(", raw_filter, re.IGNORECASE):
-                    operator = "and"
-                    raw_filter = tokens[1][raw_filter.index('('):].strip()
-                elif re.match(r"^\s*or\s*\(", raw_filter, re.IGNORECASE):
-                    operator = "or"
-                    raw_filter = tokens[1][raw_filter.index('('):].strip()
-                else:
-                    raise ValueError("invalid boolean operator near \"{}\"".format(raw_filter.strip()))
-
-        if raw_filter or len(terms)==0:
-            # second condition is to ensure at least one term, even if blank
-            terms.append([operator, raw_filter])
-
-        sourcelist = self.catalog.copy()
-        matched = {}
-
-        logger.debug("get(): {}".format(terms))
-
-        for operator, term in terms:
-            if operator == "and":
-                sourcelist = matched
-                matched = {}
-
-            """extra search term types added here"""
-
-            if not term:
-                # return everything
-                matched = sourcelist
-
-            elif term.startswith("id:"):
-                # explicit request for single conv
-                convid = term[3:]
-                matched[convid] = sourcelist[convid]
-
-            elif term in sourcelist:
-                # prioritise exact convid matches
-                matched[term] = sourcelist[term]
-
-            elif term.startswith("text:"):
-                # perform case-insensitive search
-                filter_lower = term[5:].lower()
-                for convid, convdata in sourcelist.items():
-                    if filter_lower in convdata["title"].lower():
-                        matched[convid] = convdata
-
-            elif term.startswith("chat_id:"):
-                # return all conversations user is in
-                filter_chat_id = term[8:]
-                for convid, convdata in sourcelist.items():
-                    for chat_id in convdata["participants"]:
-                        if filter_chat_id == chat_id:
-                            matched[convid] = convdata
-
-            elif term.startswith("tag:"):
-                # return all conversations with the tag
-                filter_tag = term[4:]
-                if filter_tag in self.bot.tags.indices["tag-convs"]:
-                    for conv_id in self.bot.tags.indices["tag-convs"][filter_tag]:
-                        if conv_id in sourcelist:
-                            matched[conv_id] = sourcelist[conv_id]
-
-            elif term.startswith("type:"):
-                # return all conversations with matching type (case-insensitive)
-                filter_type = term[5:]
-                for convid, convdata in sourcelist.items():
-                    if convdata["type"].lower() == filter_type.lower():
-                        matched[convid] = convdata
-
-            elif term.startswith("minusers:"):
-                # return all conversations with number of users or higher
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) >= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("maxusers:"):
-                # return all conversations with number of users or lower
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) <= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("random:"):
-                # return random conversations based on selection threshold
-                filter_random = term[7:]
-                for convid, convdata in sourcelist.items():
-                    if random.random() <= float(filter_random):
-                        matched[convid] = convdata
-
-        return matched
+        # a clause with a blank term matches everything
+        clauses = [ clause for clause in compile_filter(filter) if "" not in clause ]
+
+        logger.debug("get(): {}".format(clauses))
+
+        if not clauses:
+            return dict(self.catalog)
+
+        # random samples whatever is left, always last
+        clauses.sort(key=lambda clause: (any(term.startswith("random:") for term in clause),
+                                         sum(self._term_estimate(term) for term in clause)))
+
+        first = clauses[0]
+        if any(term.startswith("random:") for term in first):
+            conv_ids = self._clause_filter(first, set(self.catalog))
+        elif len(first) == 1:
+            conv_ids = self._term_ids(first[0])
+        else:
+            conv_ids = set().union(*[ self._term_ids(term) for term in first ])
+
+        for clause in clauses[1:]:
+            if not conv_ids:
+                break
+            if (any(term.startswith("random:") for term in clause)
+                    or len(conv_ids) < sum(self._term_estimate(term) for term in clause)):
+                # fewer candidates than the clause could match, test them instead
+                conv_ids = self._clause_filter(clause, conv_ids)
+            else:
+                conv_ids = conv_ids & set().union(*[ self._term_ids(term) for term in clause ])
+
+        return { convid: self.catalog[convid] for convid in conv_ids if convid in self.catalog }
+
+    def _clause_filter(self, clause, conv_ids):
+        if len(clause) == 1:
+            return self._term_filter(clause[0], conv_ids)
+        return set().union(*[ self._term_filter(term, conv_ids) for term in clause ])
+
+    def _term_estimate(self, term):
+        """upper bound of the number of matches for a single filter term"""
+        if term.startswith("id:") or term in self.catalog:
+            return 1
+        elif term.startswith("text:"):
+            filter_lower = term[5:].lower()
+            if len(filter_lower) < 3:
+                return len(self.catalog)
+            return min(len(self._index_trigram.get(trigram, ())) for trigram in self._trigrams(filter_lower))
+        elif term.startswith("chat_id:"):
+            return len(self._index_participant.get(term[8:], ()))
+        elif term.startswith("tag:"):
+            return len(self.bot.tags.indices["tag-convs"].get(term[4:], ()))
+        elif term.startswith("type:"):
+            return len(self._index_type.get(term[5:].lower(), ()))
+        elif term.startswith("minusers:"):
+            return len(self._index_count) - bisect.bisect_left(self._index_count, (int(term[9:]),))
+        elif term.startswith("maxusers:"):
+            return bisect.bisect_left(self._index_count, (int(term[9:]) + 1,))
+        elif term.startswith("random:"):
+            return len(self.catalog)
+        return 0
+
+    def _term_filter(self, term, conv_ids):
+        """subset of conv_ids matching a single filter term, same semantics as _term_ids()"""
+        if term.startswith("id:"):
+            return conv_ids & { term[3:] }
+        elif term in self.catalog:
+            return conv_ids & { term }
+        elif term.startswith("text:"):
+            filter_lower = term[5:].lower()
+            return { convid for convid in conv_ids if filter_lower in self._titles_lower.get(convid, "") }
+        elif term.startswith("chat_id:"):
+            return conv_ids & self._index_participant.get(term[8:], set())
+        elif term.startswith("tag:"):
+            return conv_ids & set(self.bot.tags.indices["tag-convs"].get(term[4:], ()))
+        elif term.startswith("type:"):
+            return conv_ids & self._index_type.get(term[5:].lower(), set())
+        elif term.startswith("minusers:"):
+            filter_numusers = int(term[9:])
+            return { convid for convid in conv_ids if len(self.catalog[convid]["participants"]) >= filter_numusers }
+        elif term.startswith("maxusers:"):
+            filter_numusers = int(term[9:])
+            return { convid for convid in conv_ids if len(self.catalog[convid]["participants"]) <= filter_numusers }
+        elif term.startswith("random:"):
+            filter_random = float(term[7:])
+            return { convid for convid in conv_ids if random.random() <= filter_random }
+        return set()
+
+    def _term_ids(self, term):
+        """conversation ids matching a single filter term from the indexes, None for everything"""
+
+        """extra search term types added here"""
+
+        if not term:
+            return None
+
+        elif term.startswith("id:"):
+            # explicit request for single conv
+            return { term[3:] }
+
+        elif term in self.catalog:
+            # prioritise exact convid matches
+            return { term }
+
+        elif term.startswith("text:"):
+            # perform case-insensitive search
+            filter_lower = term[5:].lower()
+            if len(filter_lower) < 3:
+                return { convid for convid, title in self._titles_lower.items() if filter_lower in title }
+            candidates = sorted([ self._index_trigram.get(trigram, set()) for trigram in self._trigrams(filter_lower) ], key=len)
+            candidates = set.intersection(*candidates)
+            return { convid for convid in candidates if filter_lower in self._titles_lower[convid] }
+
+        elif term.startswith("chat_id:"):
+            # return all conversations user is in
+            return self._index_participant.get(term[8:], set())
+
+        elif term.startswith("tag:"):
+            # return all conversations with the tag
+            filter_tag = term[4:]
+            if filter_tag in self.bot.tags.indices["tag-convs"]:
+                return set(self.bot.tags.indices["tag-convs"][filter_tag])
+            return set()
+
+        elif term.startswith("type:"):
+            # return all conversations with matching type (case-insensitive)
+            return self._index_type.get(term[5:].lower(), set())
+
+        elif term.startswith("minusers:"):
+            # return all conversations with number of users or higher
+            position = bisect.bisect_left(self._index_count, (int(term[9:]),))
+            return { convid for count, convid in self._index_count[position:] }
+
+        elif term.startswith("maxusers:"):
+            # return all conversations with number of users or lower
+            position = bisect.bisect_left(self._index_count, (int(term[9:]) + 1,))
+            return { convid for count, convid in self._index_count[:position] }
+
+        return set()
 
     def get_name(self, conv, truncate=False, fallback_string=False):
         """drop-in replacement for hangups.ui.utils.get_conv_name
@@ -164,10 +164,13 @@ def register_admin_command(command_names, tags=None):
         command_names = [command_names]
     tracking.register_command("admin", command_names, tags=tags)
 
-def register_handler(function, type="message", priority=50):
-    """register external handler"""
+def register_handler(function, type="message", priority=50, timeout=None, filters=None):
+    """register external handler, timeout (seconds) cancels a slow coroutine handler
+    filters limit the events it is called for, e.g.
+        { "prefix": "/me", "config": ["syncing_enabled"], "conv_tags": ["games"] }
+    see handlers.compile_filters() for all keys"""
     bot_handlers = tracking.bot._handlers
-    bot_handlers.register_handler(function, type, priority)
+    bot_handlers.register_handler(function, type, priority, timeout=timeout, filters=filters)
 
 def register_shared(id, objectref, forgiving=True):
     """register shared object"""
@@ -445,11 +448,14 @@ def unload(bot, module_path):
                         logger.debug("deregistering tagged command {}".format(command_name))
                         del command.command_tagsets[command_name]
 
+            command.invalidate()
+
             for type in bot._handlers.pluggables:
                 for handler in bot._handlers.pluggables[type]:
                     if handler[2]["module.path"] == module_path:
                         logger.debug("removing handler {} {}".format(type, handler))
                         bot._handlers.pluggables[type].remove(handler)
+            bot._handlers.invalidate()
 
             shared = plugin["shared"]
             for shared_def in shared:
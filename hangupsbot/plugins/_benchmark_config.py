@@ -0,0 +1,62 @@
+"""config/memory accessor micro-benchmark
+compares the previous reduce/exception based lookups with the single pass walker
+* /bot benchmarkconfig [iterations]
+"""
+
+import functools, logging, time
+
+import plugins
+
+
+logger = logging.getLogger(__name__)
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["benchmarkconfig"])
+
+
+def _legacy_get_by_path(config, keys_list):
+    return functools.reduce(lambda d, k: d[int(k) if isinstance(d, list) else k], keys_list, config)
+
+
+def _legacy_exists(config, keys_list):
+    _exists = True
+    try:
+        if _legacy_get_by_path(config, keys_list) is None:
+            _exists = False
+    except (KeyError, TypeError):
+        _exists = False
+    return _exists
+
+
+def _timeit(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1000000
+
+
+def benchmarkconfig(bot, event, *args):
+    iterations = int(args[0]) if args else 100000
+
+    chat_id = event.user.id_.chat_id
+    hit = ("user_data", chat_id, "_hangups")
+    miss = ("user_data", chat_id, "_benchmark_missing")
+    memory = bot.memory
+
+    results = [
+        ("exists hit", _timeit(lambda: _legacy_exists(memory, hit), iterations),
+                       _timeit(lambda: memory.exists(hit), iterations)),
+        ("exists miss", _timeit(lambda: _legacy_exists(memory, miss), iterations),
+                        _timeit(lambda: memory.exists(miss), iterations)),
+        ("exists+get", _timeit(lambda: _legacy_exists(memory, hit) and _legacy_get_by_path(memory, hit), iterations),
+                       _timeit(lambda: memory.get_or_default(hit), iterations)),
+        ("get_by_path", _timeit(lambda: _legacy_get_by_path(memory, ("user_data",)), iterations),
+                        _timeit(lambda: memory.get_by_path(("user_data",)), iterations)) ]
+
+    lines = [ "<b>config accessors</b>, {} iterations, usec/call legacy -> current".format(iterations) ]
+    for label, legacy, current in results:
+        lines.append("{}: {:.2f} -> {:.2f}".format(label, legacy, current))
+        logger.info("{}: {:.2f} -> {:.2f} usec".format(label, legacy, current))
+
+    yield from bot.coro_send_message(event.conv, "<br />".join(lines))
@@ -0,0 +1,113 @@
+"""handler dispatch benchmark
+registers synthetic handlers on a scratch copy of the event handler and compares the previous
+per-event signature inspection in run_pluggable_omnibus() with the precomputed dispatch records,
+and handlers that return early for unrelated messages with the same handlers registered with filters
+* /bot benchmarkhandlers [handlers] [events]
+"""
+
+import asyncio, copy, inspect, logging, time
+
+import plugins
+
+from commands import command
+
+
+logger = logging.getLogger(__name__)
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["benchmarkhandlers"])
+
+
+def _handler_coroutine(bot, event, command):
+    pass
+
+def _handler_short(bot, event):
+    pass
+
+def _handler_function(bot, event, command):
+    pass
+
+_UNMATCHED = "/benchmark-unmatched"
+
+def _handler_unmatched(bot, event, command):
+    if not event.text.startswith(_UNMATCHED):
+        return
+
+
+@asyncio.coroutine
+def _legacy_omnibus(handlers, name, *args, **kwargs):
+    """run_pluggable_omnibus() before dispatch records (exception handling omitted)"""
+    for function, priority, plugin_metadata in handlers:
+        message = ["{}: {}.{}".format(
+                    name,
+                    plugin_metadata["module.path"],
+                    function.__name__)]
+
+        _expected = list(inspect.signature(function).parameters)
+        _passed = args[0:len(_expected)]
+        if asyncio.iscoroutinefunction(function):
+            message.append("coroutine")
+            logger.debug(" : ".join(message))
+            yield from function(*_passed)
+        else:
+            message.append("function")
+            logger.debug(" : ".join(message))
+            function(*_passed)
+
+
+def _scratch_handlers(bot, records):
+    scratch = copy.copy(bot._handlers)
+    scratch.pluggables = { "benchmark": records }
+    scratch.invalidate()
+    return scratch
+
+
+@asyncio.coroutine
+def _timed_events(scratch, events, *args):
+    start = time.perf_counter()
+    for _ in range(events):
+        yield from scratch.run_pluggable_omnibus("benchmark", *args)
+    return (time.perf_counter() - start) / events * 1000000
+
+
+def benchmarkhandlers(bot, event, *args):
+    count = int(args[0]) if args else 60
+    events = int(args[1]) if len(args) > 1 else 1000
+
+    metadata = { "module.path": __name__ }
+    functions = [ asyncio.coroutine(_handler_coroutine),
+                  asyncio.coroutine(_handler_short),
+                  _handler_function ]
+
+    records = []
+    for index in range(count):
+        function = functions[index % len(functions)]
+        records.append(bot._handlers.handler_record(function, "benchmark", 50, metadata))
+
+    legacy_handlers = [ record[0:3] for record in records ]
+
+    start = time.perf_counter()
+    for _ in range(events):
+        yield from _legacy_omnibus(legacy_handlers, "benchmark", bot, event, command)
+    legacy = (time.perf_counter() - start) / events * 1000000
+
+    current = yield from _timed_events(_scratch_handlers(bot, records), events, bot, event, command)
+
+    function = asyncio.coroutine(_handler_unmatched)
+    unfiltered = yield from _timed_events(
+        _scratch_handlers(bot, [ bot._handlers.handler_record(function, "benchmark", 50, metadata)
+                                 for _ in range(count) ]),
+        events, bot, event, command)
+    filtered = yield from _timed_events(
+        _scratch_handlers(bot, [ bot._handlers.handler_record(function, "benchmark", 50, metadata,
+                                                              filters={ "prefix": _UNMATCHED })
+                                 for _ in range(count) ]),
+        events, bot, event, command)
+
+    message = ( "<b>handler dispatch</b>, {} handlers, {} events: {:.0f} -> {:.0f} usec/event<br />"
+                "unmatched messages, early return -> filters: {:.0f} -> {:.0f} usec/event" ).format(
+        count, events, legacy, current, unfiltered, filtered)
+    logger.info(message)
+
+    yield from bot.coro_send_message(event.conv, message)
@@ -0,0 +1,209 @@
+"""permamem benchmarks
+builds a synthetic catalog and compares the previous sequential scan of
+conversation_memory.get() with the indexed, compiled filters
+* /bot benchmarkconvfilter [conversations]
+measures the memory held by convmem and the user cache as plain dicts and as records
+* /bot benchmarkrecords [users] [conversations]
+"""
+
+import json, logging, random, re, time, tracemalloc
+
+import plugins
+
+from permamem import conversation_memory, compact_records
+
+
+logger = logging.getLogger(__name__)
+
+
+_WORDS = [ "project", "team", "family", "chat", "alpha", "beta", "weekend", "office", "hiking", "games",
+           "music", "dev", "ops", "support", "trip", "book", "club", "lunch", "news", "random" ]
+
+_FILTERS = [ "chat_id:user1",
+             "type:ONE_TO_ONE",
+             "text:hiking club",
+             "minusers:40",
+             "(type:GROUP) and (chat_id:user7)",
+             "(chat_id:user3) or (chat_id:user4) and (minusers:5)",
+             "(text:team) and (maxusers:3) and (type:GROUP)" ]
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["benchmarkconvfilter", "benchmarkrecords"])
+
+
+def _legacy_get(catalog, filter):
+    """conversation_memory.get() before indexes and compiled filters (tag: and random: omitted)"""
+    terms = []
+    raw_filter = filter.strip()
+    operator = "start"
+    while raw_filter.startswith("("):
+        tokens = re.split(r"(?<!\\)(?:\\\\)*\)", raw_filter, maxsplit=1)
+        terms.append([operator, tokens[0][1:]])
+        if len(tokens) == 2:
+            raw_filter = tokens[1]
+            if not raw_filter:
+                pass
+            elif re.match(r"^\s*and\s*\(", raw_filter, re.IGNORECASE):
+                operator = "and"
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            elif re.match(r"^\s*or\s*\(", raw_filter, re.IGNORECASE):
+                operator = "or"
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            else:
+                raise ValueError("invalid boolean operator near \"{}\"".format(raw_filter.strip()))
+
+    if raw_filter or len(terms)==0:
+        terms.append([operator, raw_filter])
+
+    sourcelist = catalog.copy()
+    matched = {}
+
+    for operator, term in terms:
+        if operator == "and":
+            sourcelist = matched
+            matched = {}
+
+        if not term:
+            matched = sourcelist
+        elif term.startswith("id:"):
+            convid = term[3:]
+            matched[convid] = sourcelist[convid]
+        elif term in sourcelist:
+            matched[term] = sourcelist[term]
+        elif term.startswith("text:"):
+            filter_lower = term[5:].lower()
+            for convid, convdata in sourcelist.items():
+                if filter_lower in convdata["title"].lower():
+                    matched[convid] = convdata
+        elif term.startswith("chat_id:"):
+            filter_chat_id = term[8:]
+            for convid, convdata in sourcelist.items():
+                for chat_id in convdata["participants"]:
+                    if filter_chat_id == chat_id:
+                        matched[convid] = convdata
+        elif term.startswith("type:"):
+            filter_type = term[5:]
+            for convid, convdata in sourcelist.items():
+                if convdata["type"].lower() == filter_type.lower():
+                    matched[convid] = convdata
+        elif term.startswith("minusers:"):
+            for convid, convdata in sourcelist.items():
+                if len(convdata["participants"]) >= int(term[9:]):
+                    matched[convid] = convdata
+        elif term.startswith("maxusers:"):
+            for convid, convdata in sourcelist.items():
+                if len(convdata["participants"]) <= int(term[9:]):
+                    matched[convid] = convdata
+
+    return matched
+
+
+def _synthetic_memory(bot, conversations, users=20000):
+    generator = random.Random(0)
+    memory = conversation_memory(bot)
+    for index in range(conversations):
+        if generator.random() < 0.4:
+            participants = [ "user{}".format(generator.randrange(users)) ]
+            conv_type = "ONE_TO_ONE"
+        else:
+            participants = [ "user{}".format(generator.randrange(users))
+                             for _ in range(int(generator.paretovariate(1.2)) + 1) ]
+            conv_type = "GROUP"
+        memory.catalog_set("conv{}".format(index), {
+            "title": " ".join(generator.sample(_WORDS, 3)),
+            "type": conv_type,
+            "history": True,
+            "source": "benchmark",
+            "participants": sorted(set(participants)) })
+    return memory
+
+
+def _timeit(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = func()
+    return (time.perf_counter() - start) / iterations * 1000, result
+
+
+def benchmarkconvfilter(bot, event, *args):
+    conversations = int(args[0]) if args else 100000
+
+    start = time.perf_counter()
+    memory = _synthetic_memory(bot, conversations)
+    build_time = time.perf_counter() - start
+
+    lines = [ "<b>conversation filters</b>, {} conversations (indexed in {:.1f}s), ms/query legacy -> current".format(
+        conversations, build_time) ]
+
+    for filter in _FILTERS:
+        legacy_time, legacy = _timeit(lambda: _legacy_get(memory.catalog, filter), 3)
+        current_time, current = _timeit(lambda: memory.get(filter), 3)
+        status = "" if set(legacy) == set(current) else " <b>MISMATCH</b>"
+        lines.append("{}: {} matches, {:.2f} -> {:.2f}{}".format(filter, len(current), legacy_time, current_time, status))
+        logger.info("{}: {} matches, {:.2f}ms -> {:.2f}ms{}".format(filter, len(current), legacy_time, current_time, status))
+
+    yield from bot.coro_send_message(event.conv, "<br />".join(lines))
+
+
+def _synthetic_tree(users, conversations):
+    generator = random.Random(0)
+    user_data = {}
+    for index in range(users):
+        chat_id = "1{:020d}".format(index)
+        user_data[chat_id] = { "_hangups": {
+            "chat_id": chat_id,
+            "gaia_id": chat_id,
+            "full_name": "User {}".format(index),
+            "first_name": "User",
+            "photo_url": "//lh3.googleusercontent.com/{}/photo.jpg".format(index),
+            "emails": [],
+            "is_self": False,
+            "is_definitive": True,
+            "updated": "20160101000000" }}
+
+    chat_ids = list(user_data)
+    convmem = {}
+    for index in range(conversations):
+        members = 1 if generator.random() < 0.4 else int(generator.paretovariate(1.2)) + 1
+        convmem["conv{}".format(index)] = {
+            "title": " ".join(generator.sample(_WORDS, 3)),
+            "type": "ONE_TO_ONE" if members == 1 else "GROUP",
+            "history": True,
+            "source": "init",
+            "updated": "20160101000000",
+            "participants": generator.sample(chat_ids, min(members, len(chat_ids))) }
+
+    return { "convmem": convmem, "user_data": user_data }
+
+
+def _traced_size(text, compact):
+    """bytes still allocated after loading text as memory would, optionally compacted"""
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tree = json.loads(text)
+        if compact:
+            compact_records(tree["convmem"], tree["user_data"])
+        return tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+
+def benchmarkrecords(bot, event, *args):
+    users = int(args[0]) if args else 50000
+    conversations = int(args[1]) if len(args) > 1 else 10000
+
+    text = json.dumps(_synthetic_tree(users, conversations))
+
+    before = _traced_size(text, False)
+    after = _traced_size(text, True)
+
+    message = "<b>memory records</b>, {} users, {} conversations: {:.1f} MB -> {:.1f} MB ({:.0f}%)".format(
+        users, conversations, before / 1048576, after / 1048576, 100 * (before - after) / before)
+    logger.info(message)
+
+    yield from bot.coro_send_message(event.conv, message)
@@ -0,0 +1,75 @@
+"""command availability unit test
+runs a scratch command dispatcher against a synthetic config, the results of the live dispatcher
+are left untouched
+* /bot commandstagmasks - tagged commands stay available when checked in several conversations
+  in a row, each conversation interning tags the previous ones did not use
+"""
+
+import logging, types
+
+import plugins
+
+from commands import CommandDispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["commandstagmasks"])
+
+
+def _command(bot, event, *args):
+    pass
+
+
+def _scratch_bot(commands_tagged, active_tags):
+    """minimal bot for CommandDispatcher.get_available_commands()
+    commands_tagged: { conv_id: commands_tagged config }
+    active_tags: frozenset of tags the user has in every conversation"""
+    def get_config_suboption(conv_id, option):
+        if option == "admins":
+            return []
+        if option == "commands_tagged":
+            return commands_tagged.get(conv_id)
+        return None
+
+    return types.SimpleNamespace(
+        config = types.SimpleNamespace(version=0),
+        tags = types.SimpleNamespace(useractive=lambda chat_id, conv_id: active_tags),
+        get_config_option = lambda option: None,
+        get_config_suboption = get_config_suboption)
+
+
+def commandstagmasks(bot, event, *args):
+    conversations = [ ("CONV_ALPHA", "alphacommand", "alpha"),
+                      ("CONV_BETA", "betacommand", "beta"),
+                      ("CONV_GAMMA", "gammacommand", "gamma") ]
+
+    scratch_bot = _scratch_bot(
+        { conv_id: { command_name: [tag] } for conv_id, command_name, tag in conversations },
+        frozenset(tag for conv_id, command_name, tag in conversations))
+
+    dispatcher = CommandDispatcher()
+    dispatcher.set_bot(scratch_bot)
+    for conv_id, command_name, tag in conversations:
+        # admin-only unless the user carries the tag
+        dispatcher.commands[command_name] = _command
+        dispatcher.admin_commands.append(command_name)
+    dispatcher.invalidate()
+
+    failures = []
+    for attempt in range(2): # second pass is served from the caches
+        for conv_id, command_name, tag in conversations:
+            available = dispatcher.get_available_commands(scratch_bot, "USER", conv_id)
+            if command_name not in available["admin"]:
+                failures.append("{} pass {}: {} missing".format(conv_id, attempt + 1, command_name))
+
+    if failures:
+        message = "<b>commandstagmasks: FAILED</b><br />" + "<br />".join(failures)
+        logger.error("commandstagmasks: {}".format(failures))
+    else:
+        message = "<b>commandstagmasks: passed</b>"
+        logger.info("commandstagmasks: passed")
+
+    yield from bot.coro_send_message(event.conv, message)
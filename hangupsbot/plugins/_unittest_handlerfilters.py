@@ -0,0 +1,49 @@
+"""handler filter unit test
+* /bot handlerfilters - prefix and text filters are accepted for message events and rejected
+  for every event type without message text, including typing and watermark events whose
+  text is a fixed placeholder
+"""
+
+import logging
+
+import plugins
+
+from handlers import compile_filters
+
+
+logger = logging.getLogger(__name__)
+
+
+def _initialise(bot):
+    plugins.register_admin_command(["handlerfilters"])
+
+
+def handlerfilters(bot, event, *args):
+    # event type: whether prefix/text filters are accepted
+    expected = { "message": True,
+                 "allmessages": True,
+                 "call": False,
+                 "membership": False,
+                 "rename": False,
+                 "typing": False,
+                 "watermark": False }
+
+    failures = []
+    for type, accepted in sorted(expected.items()):
+        for filters in ({ "prefix": type }, { "text": "^" + type + "$" }):
+            try:
+                compile_filters(type, filters)
+                result = True
+            except ValueError:
+                result = False
+            if result != accepted:
+                failures.append("{} {}: {}".format(type, filters, "accepted" if result else "rejected"))
+
+    if failures:
+        message = "<b>handlerfilters: FAILED</b><br />" + "<br />".join(failures)
+        logger.error("handlerfilters: {}".format(failures))
+    else:
+        message = "<b>handlerfilters: passed</b>"
+        logger.info("handlerfilters: passed")
+
+    yield from bot.coro_send_message(event.conv, message)
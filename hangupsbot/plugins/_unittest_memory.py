@@ -3,19 +3,24 @@ all these commands work on memory.json
 * creating, updating, removing a string in memory["unittest"] (memory test)
 * creating, updating, removing a string in memory["unittest"]["timestamp"] (submemory test)
 * retrieving and setting taint status of memory
+* failsafe backup rotation next to a sqlite migration backup and a manual *.bak copy,
+  in a temporary directory (memoryrotation)
+* generic copies of a lazily loaded tree hold parsed values, never placeholders (memorylazycopy)
 """
 
-import logging, time
+import copy, json, logging, os, shutil, tempfile, time
 
 import plugins
 
+import config, memory_sqlite
+
 
 logger = logging.getLogger(__name__)
 
 
 def _initialise(bot):
     plugins.register_admin_command(["memorytaint", "memoryuntaint", "memorystatus",
-                                    "memoryset", "memoryget", "memorypop", "memorysave", "memorydelete",
+                                    "memoryset", "memoryget", "memorypop", "memorysave", "memorydelete", "memoryrotation", "memorylazycopy",
                                     "submemoryinit", "submemoryclear", "submemoryset", "submemoryget", "submemorypop", "submemorydelete"])
 
 
@@ -92,3 +97,72 @@ def memorydelete(bot, event, *args):
 def submemorydelete(bot, event, *args):
     the_string = bot.memory.pop_by_path(["unittest-submemory", "timestamp"])
     logger.info("submemorydelete: {}".format(the_string))
+
+
+def memoryrotation(bot, event, *args):
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, "memory.json")
+        with open(filename, "w") as f:
+            json.dump({ "user_data": { "1": {} }, "unittest": 0 }, f)
+        memory_sqlite.import_json(filename, os.path.join(path, "memory.sqlite"))
+        migration_backup = filename + ".pre-sqlite"
+        manual_backup = filename + ".manual.bak"
+        shutil.copy2(filename, manual_backup)
+
+        # both copies keep the mtime of the original file, older than any failsafe backup
+        os.utime(migration_backup, (0, 0))
+        os.utime(manual_backup, (0, 0))
+        for age, name in enumerate([ "20150101000000.bak", "20150102000000.00000000.bak" ]):
+            open(filename + "." + name, "w").close()
+            os.utime(filename + "." + name, (age + 1, age + 1))
+
+        memory = config.Config(filename, failsafe_backups=2)
+        for value in range(3):
+            memory["unittest"] = value
+            memory.flush()
+
+        backups = sorted(name for name in os.listdir(path) if name.startswith("memory.json."))
+        removed = [ backup for backup in (migration_backup, manual_backup) if not os.path.exists(backup) ]
+        if removed:
+            logger.error("memoryrotation: FAILED, {} removed by rotation {}".format(removed, backups))
+        else:
+            logger.info("memoryrotation: passed {}".format(backups))
+    finally:
+        shutil.rmtree(path)
+
+
+def memorylazycopy(bot, event, *args):
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, "memory.json")
+        expected = { "large": { str(index): "unittest" * 10 for index in range(1000) }, "small": 1 }
+        writer = config.Config(filename)
+        writer["large"] = expected["large"]
+        writer["small"] = expected["small"]
+        writer.flush()
+
+        failed = []
+        copies = [ ("dict()", lambda tree: dict(tree)),
+                   ("dict(**tree)", lambda tree: dict(**tree)),
+                   ("copy.copy()", copy.copy),
+                   ("copy.deepcopy()", copy.deepcopy),
+                   (".copy()", lambda tree: tree.copy()) ]
+        for label, function in copies:
+            # a fresh load for every copy, so none of them finds the values already parsed
+            memory = config.Config(filename, lazy=True)
+            if not memory.config.pending:
+                failed.append("{}: nothing deferred".format(label))
+                continue
+            try:
+                if function(memory.config) != expected:
+                    failed.append(label)
+            except Exception as e:
+                failed.append("{}: {}".format(label, e))
+
+        if failed:
+            logger.error("memorylazycopy: FAILED {}".format(failed))
+        else:
+            logger.info("memorylazycopy: passed")
+    finally:
+        shutil.rmtree(path)
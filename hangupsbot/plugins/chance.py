@@ -6,7 +6,7 @@ import plugins
 
 
 def _initialise(bot):
-    plugins.register_handler(_handle_me_action)
+    plugins.register_handler(_handle_me_action, filters={ "prefix": "/me" })
     plugins.register_user_command(["diceroll", "coinflip"])
 
 
@@ -11,7 +11,8 @@ logger = logging.getLogger(__name__)
 
 
 def _initialise():
-    plugins.register_handler(_watch_image_link, type="message")
+    # immediately reject anything with spaces, must be a link
+    plugins.register_handler(_watch_image_link, type="message", filters={ "text": r"^[^ ]+$" })
 
 
 @asyncio.coroutine
@@ -20,10 +21,6 @@ def _watch_image_link(bot, event, command):
     if event.user.is_self:
         return
 
-    if " " in event.text:
-        """immediately reject anything with spaces, must be a link"""
-        return
-
     probable_image_link = False
     event_text_lower = event.text.lower()
 
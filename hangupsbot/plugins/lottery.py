@@ -9,7 +9,7 @@ logger = logging.getLogger(__name__)
 
 
 def _initialise(bot):
-    plugins.register_handler(_handle_me_action)
+    plugins.register_handler(_handle_me_action, filters={ "prefix": "/me draw" })
     plugins.register_admin_command(["prepare", "perform_drawing"])
 
 
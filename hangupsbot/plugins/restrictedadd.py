@@ -17,7 +17,7 @@ _internal = __internal_vars()
 
 
 def _initialise(bot):
-    plugins.register_handler(_check_if_admin_added_me, type="membership")
+    plugins.register_handler(_check_if_admin_added_me, type="membership", filters={ "subtypes": ["JOIN"] })
     plugins.register_handler(_verify_botkeeper_presence, type="message")
     plugins.register_admin_command(["allowbotadd", "removebotadd"])
 
@@ -18,87 +18,122 @@ class tags:
 
     def __init__(self, bot):
         self.bot = bot
+
+        """resolved useractive() results, dropped by invalidate() when anything they depend on changes"""
+        self._active = {} # (chat_id, conv_id): frozenset of tags
+        self._active_by_chat = {} # chat_id: set of cached conv_ids
+        self._active_by_conv = {} # conv_id: set of cached chat_ids
+
+        self.version = 0 # incremented whenever an index changes
+
         self.refresh_indices()
 
     def _load_from_memory(self, key, type):
-        if self.bot.memory.exists([key]):
-            for id, data in self.bot.memory[key].items():
-                if "tags" in data:
-                    for tag in data["tags"]:
-                        self.add_to_index(type, tag, id)
+        for id, [tags] in self.bot.memory.record_fields(key, [("tags",)]):
+            if tags:
+                for tag in tags:
+                    self.add_to_index(type, tag, id)
 
     def refresh_indices(self):
         self.indices = { "user-tags": {}, "tag-users":{}, "conv-tags": {}, "tag-convs": {} }
+        self.invalidate()
+        self.version += 1
 
         self._load_from_memory("user_data", "user")
         self._load_from_memory("conv_data", "conv")
 
         # XXX: custom iteration to retrieve per-conversation-user-overrides
-        if self.bot.memory.exists(["conv_data"]):
-            for conv_id in self.bot.memory["conv_data"]:
-                if self.bot.memory.exists(["conv_data", conv_id, "tags-users"]):
-                    for chat_id, tags in self.bot.memory["conv_data"][conv_id]["tags-users"].items():
-                        for tag in tags:
-                            self.add_to_index("user", tag, conv_id + "|" + chat_id)
+        for conv_id, [tags_users] in self.bot.memory.record_fields("conv_data", [("tags-users",)]):
+            if tags_users:
+                for chat_id, tags in tags_users.items():
+                    for tag in tags:
+                        self.add_to_index("user", tag, conv_id + "|" + chat_id)
 
         logger.info("refreshed")
 
+    def invalidate(self, chat_id=None, conv_id=None):
+        """drop cached useractive() results for a user, a conversation, both or (no arguments) all"""
+        if chat_id is None and conv_id is None:
+            self._active = {}
+            self._active_by_chat = {}
+            self._active_by_conv = {}
+
+        elif conv_id is None:
+            for _conv_id in self._active_by_chat.pop(chat_id, ()):
+                del self._active[(chat_id, _conv_id)]
+                self._discard_active(self._active_by_conv, _conv_id, chat_id)
+
+        elif chat_id is None:
+            for _chat_id in self._active_by_conv.pop(conv_id, ()):
+                del self._active[(_chat_id, conv_id)]
+                self._discard_active(self._active_by_chat, _chat_id, conv_id)
+
+        elif self._active.pop((chat_id, conv_id), None) is not None:
+            self._discard_active(self._active_by_chat, chat_id, conv_id)
+            self._discard_active(self._active_by_conv, conv_id, chat_id)
+
+    @staticmethod
+    def _discard_active(index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def _invalidate_user_key(self, id):
+        """drop the cached results a user-tags key ("chat_id", "conv_id|chat_id", wildcards) can affect"""
+        conv_id, _, chat_id = id.rpartition("|")
+        if not conv_id or conv_id in (self.wildcard["group"], self.wildcard["one2one"]):
+            conv_id = None
+        if chat_id == self.wildcard["user"]:
+            chat_id = None
+        self.invalidate(chat_id, conv_id)
+
     def add_to_index(self, type, tag, id):
         tag_to_object = "tag-{}s".format(type)
         object_to_tag = "{}-tags".format(type)
 
-        if tag not in self.indices[tag_to_object]:
-            self.indices[tag_to_object][tag] = []
-        if id not in self.indices[tag_to_object][tag]:
-            self.indices[tag_to_object][tag].append(id)
+        if type == "user":
+            self._invalidate_user_key(id)
+        self.version += 1
 
-        if id not in self.indices[object_to_tag]:
-            self.indices[object_to_tag][id] = []
-        if tag not in self.indices[object_to_tag][id]:
-            self.indices[object_to_tag][id].append(tag)
+        self.indices[tag_to_object].setdefault(tag, set()).add(id)
+        self.indices[object_to_tag].setdefault(id, set()).add(tag)
 
     def remove_from_index(self, type, tag, id):
         tag_to_object = "tag-{}s".format(type)
         object_to_tag = "{}-tags".format(type)
 
-        if tag in self.indices[tag_to_object]:
-            if id in self.indices[tag_to_object][tag]:
-                self.indices[tag_to_object][tag].remove(id)
-                if len(self.indices[tag_to_object][tag]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[tag_to_object][tag])
-
-        if id in self.indices[object_to_tag]:
-            if tag in self.indices[object_to_tag][id]:
-                self.indices[object_to_tag][id].remove(tag)
-                if len(self.indices[object_to_tag][id]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[object_to_tag][id])
-
-    def update(self, type, id, action, tag):
-        updated = False
-        tags = None
-
+        if type == "user":
+            self._invalidate_user_key(id)
+        self.version += 1
+
+        ids = self.indices[tag_to_object].get(tag)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                # remove key entirely it its empty
+                del self.indices[tag_to_object][tag]
+
+        tags = self.indices[object_to_tag].get(id)
+        if tags is not None:
+            tags.discard(tag)
+            if not tags:
+                # remove key entirely it its empty
+                del self.indices[object_to_tag][id]
+
+    def _validate(self, type, id, action, tag):
         if type == "conv":
-            index_type = "conv"
-
             if id not in self.bot.conversations.catalog:
                 raise ValueError("conversation {} does not exist".format(id))
 
-            tags = self.bot.conversation_memory_get(id, "tags")
-
         elif type == "user":
-            index_type = "user"
-
             if( not self.bot.memory.exists(["user_data", id]) and
                   id != self.wildcard["user"] ):
 
                 raise ValueError("user {} is invalid".format(id))
 
-            tags = self.bot.user_memory_get(id, "tags")
-
         elif type == "convuser":
-            index_type = "user"
             [conv_id, chat_id] = id.split("|", maxsplit=1)
 
             if( conv_id not in self.bot.conversations.catalog and
@@ -111,63 +146,88 @@ class tags:
 
                 raise ValueError("user {} is invalid".format(chat_id))
 
-            tags_users = self.bot.conversation_memory_get(conv_id, "tags-users")
-
-            if not tags_users:
-                tags_users = {}
-
-            if chat_id in tags_users:
-                tags = tags_users[chat_id]
-
         else:
             raise TypeError("unhandled read type {}".format(type))
 
-        if not tags:
-            tags = []
-
         if action == "set":
             # XXX: placed here so users can still remove previous invalid tags
             allowed = "^[{}{}]*$".format(self.regex_allowed, re.escape(command.deny_prefix))
             if not re.match(allowed, tag, re.IGNORECASE):
                 raise ValueError("tag contains invalid characters")
 
-            if tag not in tags:
+        elif action != "remove":
+            raise ValueError("unrecognised action {}".format(action))
+
+    def apply(self, ops):
+        """apply a list of (type, id, action, tag) changes as one transaction
+        every op is validated before anything changes, each memory record is written once
+        and memory is saved once. returns the number of ops that changed a tag"""
+        for op in ops:
+            self._validate(*op)
+
+        records = {} # memory path: working copy of its tags list (or tags-users dict)
+        changed = set()
+        updated = 0
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        for type, id, action, tag in ops:
+            if type == "convuser":
+                index_type = "user"
+                [conv_id, chat_id] = id.split("|", maxsplit=1)
+                path = ("conv_data", conv_id, "tags-users")
+                if path not in records:
+                    records[path] = dict(self.bot.memory.get_or_default(path) or {})
+                tags = list(records[path].get(chat_id) or [])
+
+            else:
+                index_type = type
+                path = ("conv_data" if type == "conv" else "user_data", id, "tags")
+                if path not in records:
+                    records[path] = list(self.bot.memory.get_or_default(path) or [])
+                tags = records[path]
+
+            if action == "set":
+                if tag in tags:
+                    if debug:
+                        logger.debug("{}/{} action={} value={} [NO CHANGE]".format(type, id, action, tag))
+                    continue
                 tags.append(tag)
                 self.add_to_index(index_type, tag, id)
-                updated = True
 
-        elif action == "remove":
-            try:
+            else:
+                if tag not in tags:
+                    if debug:
+                        logger.debug("{}/{} action={} value={} [NO CHANGE]".format(type, id, action, tag))
+                    continue
                 tags.remove(tag)
                 self.remove_from_index(index_type, tag, id)
-                updated = True
-            except ValueError as e:
-                # in case the value does not exist
-                pass
 
-        else:
-            raise ValueError("unrecognised action {}".format(action))
+            if type == "convuser":
+                records[path][chat_id] = tags
 
-        if updated:
-            if type == "conv":
-                self.bot.conversation_memory_set(id, "tags", tags)
+            changed.add(path)
+            updated = updated + 1
+            if debug:
+                logger.debug("{}/{} action={} value={}".format(type, id, action, tag))
 
-            elif type == "user":
-                self.bot.user_memory_set(id, "tags", tags)
+        for path in changed:
+            self.bot.initialise_memory(path[1], path[0])
+            self.bot.memory.set_by_path(list(path), records[path])
 
-            elif type == "convuser":
-                tags_users[chat_id] = tags
-                self.bot.conversation_memory_set(conv_id, "tags-users", tags_users)
-
-            else:
-                raise TypeError("unhandled update type {}".format(type))
+        if changed:
+            self.bot.memory.save()
 
-            logger.info("{}/{} action={} value={}".format(type, id, action, tag))
+        if len(ops) == 1:
+            type, id, action, tag = ops[0]
+            logger.info("{}/{} action={} value={}{}".format(type, id, action, tag, "" if updated else " [NO CHANGE]"))
         else:
-            logger.info("{}/{} action={} value={} [NO CHANGE]".format(type, id, action, tag))
+            logger.info("{} of {} changes applied, {} records".format(updated, len(ops), len(changed)))
 
         return updated
 
+    def update(self, type, id, action, tag):
+        return self.apply([(type, id, action, tag)]) > 0
+
 
     def add(self, type, id, tag):
         """add tag to (type=conv|user|convuser) id"""
@@ -220,51 +280,66 @@ class tags:
         else:
             raise TypeError("{}".format(type))
 
-        records_removed = 0
-        if remove:
-            for args in remove:
-                if self.remove(*args):
-                    records_removed = records_removed + 1
-
-        return records_removed
+        return self.apply([ (type, key, "remove", tag) for type, key, tag in remove ])
 
 
     def useractive(self, chat_id, conv_id="*"):
         """return active tags of user for current conv_id if supplied, globally if not"""
+        active_tags = self._active.get((chat_id, conv_id))
+        if active_tags is None:
+            active_tags = self.useractive_many(conv_id, [chat_id])[chat_id]
+        return active_tags
 
-        active_tags = []
-        check_keys = []
-
-        if self.bot.memory.exists(["user_data", chat_id]):
-            if conv_id != "*":
-                if conv_id in self.bot.conversations.catalog:
-                    # per_conversation_user_override_keys
-                    check_keys.extend([ conv_id + "|" + chat_id,
-                                        conv_id + "|" + self.wildcard["user"] ])
 
-                    # additional overrides based on type of conversation
-                    if self.bot.conversations.catalog[conv_id]["type"] == "GROUP":
-                        check_keys.extend([ self.wildcard["group"] + "|" + chat_id,
-                                            self.wildcard["group"] + "|" + self.wildcard["user"] ])
-                    else:
-                        check_keys.extend([ self.wildcard["one2one"] + "|" + chat_id,
-                                            self.wildcard["one2one"] + "|" + self.wildcard["user"] ])
+    def useractive_many(self, conv_id, chat_ids):
+        """return { chat_id: frozenset of active tags } for users of the same conv_id (or "*")
+        results are cached until invalidate() is called for them"""
 
+        override_keys = None
+        if conv_id != "*":
+            if conv_id in self.bot.conversations.catalog:
+                # per_conversation_user_override_keys, then overrides based on type of conversation
+                if self.bot.conversations.catalog[conv_id]["type"] == "GROUP":
+                    override_keys = (conv_id, self.wildcard["group"])
                 else:
-                    logger.warning("useractive: conversation {} does not exist".format(conv_id))
+                    override_keys = (conv_id, self.wildcard["one2one"])
+            else:
+                logger.warning("useractive: conversation {} does not exist".format(conv_id))
+
+        user_tags = self.indices["user-tags"]
+
+        results = {}
+        for chat_id in chat_ids:
+            active_tags = self._active.get((chat_id, conv_id))
+            if active_tags is not None:
+                results[chat_id] = active_tags
+                continue
 
+            if not self.bot.memory.exists(("user_data", chat_id)):
+                logger.warning("useractive: user {} does not exist".format(chat_id))
+                results[chat_id] = frozenset()
+                continue
+
+            check_keys = []
+            if override_keys:
+                for prefix in override_keys:
+                    check_keys.extend([ prefix + "|" + chat_id,
+                                        prefix + "|" + self.wildcard["user"] ])
             check_keys.extend([ chat_id,
                                 self.wildcard["user"] ])
 
-        else:
-            logger.warning("useractive: user {} does not exist".format(chat_id))
+            active_tags = frozenset()
+            for _key in check_keys:
+                if _key in user_tags:
+                    active_tags = frozenset(user_tags[_key])
+                    break
 
-        for _key in check_keys:
-            if _key in self.indices["user-tags"]:
-                active_tags = self.indices["user-tags"][_key]
-                break
+            results[chat_id] = active_tags
+            self._active[(chat_id, conv_id)] = active_tags
+            self._active_by_chat.setdefault(chat_id, set()).add(conv_id)
+            self._active_by_conv.setdefault(conv_id, set()).add(chat_id)
 
-        return active_tags
+        return results
 
 
     def userlist(self, conv_id, tags=False):
@@ -280,9 +355,8 @@ class tags:
             logger.warning("userlist: conversation {} does not exist".format(conv_id))
 
         results = {}
-        for chat_id in userlist:
-            user_tags = self.useractive(chat_id, conv_id)
-            if tags and not set(tags).issubset(set(user_tags)):
+        for chat_id, user_tags in self.useractive_many(conv_id, userlist).items():
+            if tags and not user_tags.issuperset(tags):
                 continue
             results[chat_id] = user_tags
         return results